@@ -0,0 +1,168 @@
+"""
+Headless batch rendering of recordings into numbered frames.
+
+    python batchrender.py recordings/test2.grec frames/ --workers 8
+
+Renders every frame of a recording made by simfilewriter.py with the
+same drawing code as replay.py, onto offscreen surfaces, splitting the
+frame range across a pool of processes.  Frames are written as
+frame_000000.png, ... or, with --format rgb, as raw RGB24 files of
+width * height * 3 bytes.
+"""
+
+__author__ = 'charles.andrew.parker@gmail.com'
+
+import os
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import argparse
+import logging
+import multiprocessing
+import sys
+import time
+import numpy as np
+import pygame
+from camera import Camera
+from coordinate import Coordinate
+import simfileplayer
+import simulation
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+# set in each pool process by load_recording
+frames = None
+
+
+def load_recording(path):
+    global frames
+    frames = simfileplayer.open_frames(path)
+
+
+def get_camera(args):
+    camera = Camera(np.array(args.position, dtype=float), args.dimensions)
+    camera.displacement.pos = np.array(args.position, dtype=float)
+    camera.pitch = args.pitch
+    camera.yaw = args.yaw
+    camera.get_direction_vectors()
+    if args.look_at is not None:
+        camera.point_towards_target(Coordinate(args.look_at, Coordinate.get_empty_coord()))
+    return camera
+
+
+def get_frame_path(args, index):
+    return os.path.join(args.output, "frame_{:06d}.{}".format(index, args.format))
+
+
+def render_chunk(task):
+    """
+    Renders frames [start, stop).  The trails are first built up
+    from the frames just before start, so every chunk draws the same
+    image a single process would.  Returns (start, stop, seconds).
+    """
+    args, start, stop = task
+    started = time.time()
+    sim_config = {
+        "gravitational_constant": 0.5,
+        "draw_sphere_of_influence": args.draw_soi,
+        "num_bg_stars": args.num_bg_stars,
+        "planet_renderer": args.planet_renderer,
+        "trail_length": args.trail_length,
+        # every chunk gets the same background star field
+        "random_seed": args.seed}
+
+    sim = simulation.GravitySimulation(None, sim_config)
+    camera = get_camera(args)
+    surface = pygame.Surface(args.dimensions, 0, 32)
+
+    for index in range(max(0, start - (args.trail_length - 1) * args.every), start, args.every):
+        sim.set_planets(frames.get_planets(index))
+
+    for index in range(start, stop, args.every):
+        sim.set_planets(frames.get_planets(index))
+        sim.draw_background(surface, camera)
+        sim.draw_planets(surface, camera)
+        path = get_frame_path(args, index // args.every)
+        if args.format == "png":
+            pygame.image.save(surface, path)
+        else:
+            with open(path, "wb") as f:
+                f.write(pygame.image.tostring(surface, "RGB"))
+
+    return start, stop, time.time() - started
+
+
+def get_chunks(args, num_frames):
+    """
+    Contiguous frame ranges of chunk_size rendered frames, each
+    starting on a frame that is rendered.
+    """
+    stop = num_frames if args.stop is None else min(args.stop, num_frames)
+    span = args.chunk_size * args.every
+    return [(args, first, min(first + span, stop)) for first in range(args.start, stop, span)]
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Render a gravipy recording to numbered frames.")
+    parser.add_argument("recording", help="a .grec recording, or a legacy .rec file or the .zip holding one")
+    parser.add_argument("output", help="directory to write the frames to")
+    parser.add_argument("--format", default="png", choices=["png", "rgb"])
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--chunk-size", type=int, default=50,
+                        help="frames rendered by each task")
+    parser.add_argument("--start", type=int, default=0)
+    parser.add_argument("--stop", type=int, default=None)
+    parser.add_argument("--every", type=int, default=1,
+                        help="render every n-th frame of the recording")
+    parser.add_argument("--dimensions", type=int, nargs=2, default=[1680, 900])
+    parser.add_argument("--position", type=float, nargs=3, default=[0.0, 0.0, 0.0])
+    parser.add_argument("--pitch", type=float, default=np.pi / 2, help="radians")
+    parser.add_argument("--yaw", type=float, default=np.pi / 2, help="radians")
+    parser.add_argument("--look-at", type=float, nargs=3, default=None,
+                        help="point the camera at this position instead")
+    parser.add_argument("--num-bg-stars", type=int, default=250)
+    parser.add_argument("--trail-length", type=int, default=40)
+    parser.add_argument("--planet-renderer", default="circles", choices=["circles", "framebuffer"])
+    parser.add_argument("--draw-soi", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    args.dimensions = tuple(args.dimensions)
+    return args
+
+
+def main(argv):
+    args = parse_args(argv)
+    if os.path.isdir(args.output) is False:
+        os.makedirs(args.output)
+
+    started = time.time()
+    num_frames = len(simfileplayer.open_frames(args.recording))
+    chunks = get_chunks(args, num_frames)
+    log.info("Rendering {} chunks of {} frames with {} workers".format(len(chunks), num_frames, args.workers))
+
+    if args.workers <= 1:
+        load_recording(args.recording)
+        results = [render_chunk(chunk) for chunk in chunks]
+    else:
+        pool = multiprocessing.Pool(args.workers, initializer=load_recording, initargs=(args.recording,))
+        try:
+            results = []
+            for result in pool.imap_unordered(render_chunk, chunks):
+                log.info("Rendered frames {} to {} in {:.1f} s".format(*result))
+                results.append(result)
+        finally:
+            pool.close()
+            pool.join()
+
+    rendered = sum(len(range(start, stop, args.every)) for start, stop, _ in results)
+    elapsed = time.time() - started
+    log.info("Rendered {} frames in {:.1f} s".format(rendered, elapsed))
+    return rendered, elapsed
+
+
+if __name__ == "__main__":
+    handler = logging.StreamHandler()
+    handler.setLevel(logging.INFO)
+    log.addHandler(handler)
+    main(sys.argv[1:])
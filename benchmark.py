@@ -0,0 +1,298 @@
+"""
+Headless throughput benchmarks.
+
+    python benchmark.py --bodies 10 100 1000 --output bench.json
+
+Reports simulation steps/second across body counts, camera projections
+per second, drawing throughput on an offscreen Surface and recording
+write/load speed, as JSON.
+"""
+
+__author__ = 'charles.andrew.parker@gmail.com'
+
+import os
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import argparse
+import cPickle as pickle
+import json
+import logging
+import math
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+import numpy as np
+import pygame
+from camera import Camera
+from recording import Recording, RecordingWriter, DeltaRecording, DeltaRecordingWriter
+import simulation
+from instrumentation import stats
+from tracing import tracer
+
+
+def time_calls(func, min_time, min_calls=3):
+    """
+    Calls func repeatedly for at least min_time seconds and
+    min_calls calls; returns (calls, elapsed seconds).
+    """
+    calls = 0
+    start = time.time()
+    elapsed = 0.0
+    while elapsed < min_time or calls < min_calls:
+        func()
+        calls += 1
+        elapsed = time.time() - start
+    return calls, elapsed
+
+
+def generate_benchmark_config(num_bodies, seed):
+    """
+    Star systems of ten bodies laid out on a grid, trimmed
+    to exactly num_bodies bodies.
+    """
+    rng = random.Random(seed)
+    planets = []
+    per_row = int(math.ceil(math.sqrt(num_bodies / 10.0)))
+    for n in range(int(math.ceil(num_bodies / 10.0))):
+        offset = (30000 * (n % per_row), 30000 * (n // per_row), 0)
+        planets += simulation.generate_star_system_config("Sys{}".format(n), offset, 9, rng)
+    return planets[:num_bodies]
+
+
+def bench_simulation(body_counts, sim_config, min_time, seed):
+    results = []
+    for num_bodies in body_counts:
+        sim = simulation.GravitySimulation(generate_benchmark_config(num_bodies, seed), sim_config)
+        calls, elapsed = time_calls(lambda: sim.update_planets(1), min_time)
+        sim.close()
+        results.append({"bodies": num_bodies,
+                        "bodies_remaining": len(sim.planets),
+                        "steps": calls,
+                        "seconds": elapsed,
+                        "steps_per_second": calls / elapsed})
+    return results
+
+
+def get_camera(sim_config):
+    # the run.py view, nudged off the plane the generated orbits start in
+    camera = Camera(np.array([0, -5000, 300]), sim_config["dimensions"])
+    camera.displacement.pos = np.array([15.0, -5015.0, 300.0])
+    return camera
+
+
+def bench_projection(sim_config, min_time, seed):
+    sim = simulation.GravitySimulation(generate_benchmark_config(100, seed), sim_config)
+    camera = get_camera(sim_config)
+    coords = [(p.coord, p.get_radius()) for p in sim.planets]
+
+    def project():
+        for coord, radius in coords:
+            camera.get_apparent_radius_and_draw_pos(coord, radius)
+
+    calls, elapsed = time_calls(project, min_time)
+    batch_calls, batch_elapsed = time_calls(lambda: camera.project(sim.store.pos, sim.store.radius), min_time)
+    return {"projections": calls * len(coords),
+            "seconds": elapsed,
+            "projections_per_second": calls * len(coords) / elapsed,
+            "batched_projections_per_second": batch_calls * len(coords) / batch_elapsed}
+
+
+def bench_drawing(body_counts, sim_config, min_time, seed):
+    surface = pygame.Surface(sim_config["dimensions"])
+    camera = get_camera(sim_config)
+    results = {"draw_planets": [], "draw_background": None}
+
+    for num_bodies in body_counts:
+        sim = simulation.GravitySimulation(generate_benchmark_config(num_bodies, seed), sim_config)
+        calls, elapsed = time_calls(lambda: sim.draw_planets(surface, camera), min_time)
+        results["draw_planets"].append({"bodies": num_bodies,
+                                        "frames": calls,
+                                        "seconds": elapsed,
+                                        "frames_per_second": calls / elapsed})
+
+    calls, elapsed = time_calls(lambda: sim.draw_background(surface, camera), min_time)
+    results["draw_background"] = {"stars": len(sim.background_stars),
+                                  "frames": calls,
+                                  "seconds": elapsed,
+                                  "frames_per_second": calls / elapsed}
+    return results
+
+
+def bench_recording(num_bodies, num_frames, interval, sim_config, seed):
+    """
+    Times the legacy recording path: pickle every frame, pickle the
+    list of frames, zip it, then read it all back.  Then the same run
+    written as a raw columnar recording and as a delta one, each
+    opened and read in full.  A frame is kept every interval steps.
+
+    Throughputs are in megabytes of raw columnar frames per second,
+    so the two codecs compare directly.
+    """
+    sim = simulation.GravitySimulation(generate_benchmark_config(num_bodies, seed), sim_config)
+    directory = tempfile.mkdtemp(prefix="gravipy_bench")
+    try:
+        rec_path = os.path.join(directory, "bench.rec")
+        zip_path = os.path.join(directory, "bench.zip")
+        grec_path = os.path.join(directory, "bench.grec")
+        delta_path = os.path.join(directory, "bench_delta.grec")
+        initial = pickle.dumps(sim.get_planet_simulation_state())
+
+        start = time.time()
+        states = []
+        for _ in range(num_frames):
+            sim.update_planets(interval)
+            states.append(pickle.dumps(sim.get_planet_simulation_state()))
+        simulate_and_encode = time.time() - start
+
+        start = time.time()
+        with open(rec_path, "wb") as f:
+            pickle.dump(states, f)
+        with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as myzip:
+            myzip.write(rec_path, "bench.rec")
+        write_time = time.time() - start
+
+        start = time.time()
+        with zipfile.ZipFile(zip_path, "r") as myzip:
+            frames = [pickle.loads(f) for f in pickle.loads(myzip.read("bench.rec"))]
+        load_time = time.time() - start
+
+        sim.set_planets(pickle.loads(initial))
+        writer = RecordingWriter(grec_path, sim.planets, interval=interval)
+        delta_writer = DeltaRecordingWriter(delta_path, sim.planets, interval=interval)
+        columnar_write_time = 0.0
+        delta_write_time = 0.0
+        for _ in range(num_frames):
+            for _ in range(interval):
+                sim.update_planets(1)
+            start = time.time()
+            writer.write_frame(sim.store, sim.steps, sim.sim_time)
+            columnar_write_time += time.time() - start
+            start = time.time()
+            delta_writer.write_frame(sim.store, sim.steps, sim.sim_time)
+            delta_write_time += time.time() - start
+        start = time.time()
+        writer.close()
+        columnar_write_time += time.time() - start
+        start = time.time()
+        delta_writer.close()
+        delta_write_time += time.time() - start
+
+        start = time.time()
+        rec = Recording(grec_path)
+        columnar_open_time = time.time() - start
+        np.array(rec.frames["pos"])
+        columnar_load_time = time.time() - start
+        rec.close()
+
+        start = time.time()
+        rec = DeltaRecording(delta_path)
+        for k in range(len(rec.chunk_offsets)):
+            rec.get_chunk(k)
+        delta_load_time = time.time() - start
+        rec.close()
+
+        raw_mb = os.path.getsize(rec_path) / 1e6
+        zipped_mb = os.path.getsize(zip_path) / 1e6
+        columnar_mb = os.path.getsize(grec_path) / 1e6
+        delta_mb = os.path.getsize(delta_path) / 1e6
+        return {"bodies": num_bodies,
+                "frames": len(frames),
+                "interval": interval,
+                "simulate_and_encode_seconds": simulate_and_encode,
+                "raw_megabytes": raw_mb,
+                "zipped_megabytes": zipped_mb,
+                "write_seconds": write_time,
+                "write_mb_per_second": raw_mb / write_time,
+                "load_seconds": load_time,
+                "load_mb_per_second": raw_mb / load_time,
+                "columnar_megabytes": columnar_mb,
+                "columnar_write_seconds": columnar_write_time,
+                "columnar_open_seconds": columnar_open_time,
+                "columnar_load_seconds": columnar_load_time,
+                "columnar_write_mb_per_second": columnar_mb / columnar_write_time,
+                "columnar_load_mb_per_second": columnar_mb / columnar_load_time,
+                "delta_megabytes": delta_mb,
+                "delta_write_seconds": delta_write_time,
+                "delta_load_seconds": delta_load_time,
+                "delta_write_mb_per_second": columnar_mb / delta_write_time,
+                "delta_load_mb_per_second": columnar_mb / delta_load_time,
+                "delta_size_ratio": columnar_mb / delta_mb}
+    finally:
+        sim.close()
+        shutil.rmtree(directory)
+
+
+def get_environment():
+    return {"python": platform.python_version(),
+            "numpy": np.__version__,
+            "pygame": pygame.version.ver,
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Headless gravipy throughput benchmarks.")
+    parser.add_argument("--bodies", type=int, nargs="+", default=[10, 50, 200, 1000],
+                        help="body counts for the simulation and drawing benchmarks")
+    parser.add_argument("--force-solver", default="direct")
+    parser.add_argument("--integrator", default="euler")
+    parser.add_argument("--planet-renderer", default="circles", choices=["circles", "framebuffer"])
+    parser.add_argument("--min-time", type=float, default=1.0,
+                        help="seconds to spend on each measurement")
+    parser.add_argument("--recording-bodies", type=int, default=26)
+    parser.add_argument("--recording-frames", type=int, default=300)
+    parser.add_argument("--recording-interval", type=int, default=5,
+                        help="simulation steps between recorded frames")
+    parser.add_argument("--num-bg-stars", type=int, default=250)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--only", nargs="+", choices=["simulation", "projection", "drawing", "recording"],
+                        help="run only these benchmarks")
+    parser.add_argument("--output", help="write the JSON results here instead of stdout")
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    sim_config = {
+        "dimensions": (1680, 900),
+        "gravitational_constant": 0.5,
+        "draw_sphere_of_influence": False,
+        "num_bg_stars": args.num_bg_stars,
+        "enable_movement": False,
+        "force_solver": args.force_solver,
+        "integrator": args.integrator,
+        "planet_renderer": args.planet_renderer}
+    stats.configure(sim_config)
+    tracer.configure(sim_config)
+    selected = set(args.only or ["simulation", "projection", "drawing", "recording"])
+
+    results = {"environment": get_environment(), "config": sim_config}
+    if "simulation" in selected:
+        results["simulation"] = bench_simulation(args.bodies, sim_config, args.min_time, args.seed)
+    if "projection" in selected:
+        results["projection"] = bench_projection(sim_config, args.min_time, args.seed)
+    if "drawing" in selected:
+        results["drawing"] = bench_drawing(args.bodies, sim_config, args.min_time, args.seed)
+    if "recording" in selected:
+        results["recording"] = bench_recording(args.recording_bodies, args.recording_frames,
+                                               args.recording_interval, sim_config, args.seed)
+
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output is None:
+        sys.stdout.write(text + "\n")
+    else:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    return results
+
+
+if __name__ == "__main__":
+    handler = logging.StreamHandler()
+    handler.setLevel(logging.WARNING)
+    logging.getLogger().addHandler(handler)
+    main(sys.argv[1:])
@@ -0,0 +1,142 @@
+__author__ = 'charles.andrew.parker@gmail.com'
+
+import logging
+import numpy as np
+from coordinate import Coordinate
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+
+class BodyStore(object):
+    """
+    Structure-of-arrays storage for every body in a simulation.
+
+    Positions, velocities, accelerations, masses and radii live in
+    contiguous numpy arrays.  The bodies added to the store are bound
+    to a row of those arrays, so their Coordinates become views into
+    the store instead of owning their own state.
+    """
+
+    INITIAL_CAPACITY = 16
+
+    def __init__(self, bodies=()):
+        self.count = 0
+        self.bodies = []
+        self._allocate(BodyStore.INITIAL_CAPACITY)
+        for b in bodies:
+            self.add(b)
+
+    def _allocate(self, capacity):
+        self.capacity = capacity
+        self._pos = np.zeros((capacity, Coordinate.DIMENSIONS))
+        self._vel = np.zeros((capacity, Coordinate.DIMENSIONS))
+        self._acc = np.zeros((capacity, Coordinate.DIMENSIONS))
+        self._mass = np.zeros(capacity)
+        self._radius = np.zeros(capacity)
+
+    def _grow(self, capacity):
+        log.debug("Growing body store from {} to {} rows".format(self.capacity, capacity))
+        old = self._pos, self._vel, self._acc, self._mass, self._radius
+        self._allocate(capacity)
+        for new_arr, old_arr in zip((self._pos, self._vel, self._acc, self._mass, self._radius), old):
+            new_arr[:self.count] = old_arr[:self.count]
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return iter(self.bodies)
+
+    @property
+    def pos(self):
+        return self._pos[:self.count]
+
+    @pos.setter
+    def pos(self, value):
+        self._pos[:self.count] = value
+
+    @property
+    def vel(self):
+        return self._vel[:self.count]
+
+    @vel.setter
+    def vel(self, value):
+        self._vel[:self.count] = value
+
+    @property
+    def acc(self):
+        return self._acc[:self.count]
+
+    @acc.setter
+    def acc(self, value):
+        self._acc[:self.count] = value
+
+    @property
+    def mass(self):
+        return self._mass[:self.count]
+
+    @mass.setter
+    def mass(self, value):
+        self._mass[:self.count] = value
+
+    @property
+    def radius(self):
+        return self._radius[:self.count]
+
+    @radius.setter
+    def radius(self, value):
+        self._radius[:self.count] = value
+
+    def add(self, body):
+        """
+        Copies the body's current state into a new row
+        and binds the body to it.
+        """
+        if self.count == self.capacity:
+            self._grow(2 * self.capacity)
+
+        index = self.count
+        self._pos[index] = body.coord.pos
+        self._vel[index] = body.coord.vel
+        self._acc[index] = body.coord.acc
+        self._mass[index] = body.mass
+        self._radius[index] = body.get_radius()
+        self.count += 1
+        self.bodies.append(body)
+        body.bind(self, index)
+        return index
+
+    def remove(self, indices):
+        """
+        Removes the bodies at the given rows.  Removed bodies are
+        unbound and keep a copy of their final state; the remaining
+        rows are compacted and their bodies re-indexed.
+        """
+        indices = np.unique(np.asarray(indices, dtype=int))
+        if len(indices) == 0:
+            return []
+
+        for i in indices:
+            self.bodies[i].unbind()
+
+        keep = np.ones(self.count, dtype=bool)
+        keep[indices] = False
+        removed = [self.bodies[i] for i in indices]
+
+        remaining = int(keep.sum())
+        for arr in (self._pos, self._vel, self._acc, self._mass, self._radius):
+            arr[:remaining] = arr[:self.count][keep]
+
+        self.bodies = [b for b, k in zip(self.bodies, keep) if k]
+        self.count = remaining
+        for index, b in enumerate(self.bodies):
+            b.bind(self, index)
+
+        return removed
+
+    def clear(self):
+        for b in self.bodies:
+            b.unbind()
+        self.bodies = []
+        self.count = 0
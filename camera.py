@@ -1,6 +1,7 @@
 __author__ = 'charles.andrew.parker@gmail.com'
 
 from coordinate import Coordinate
+from tracing import tracer
 import numpy as np
 import pygame
 import logging
@@ -89,13 +90,10 @@ class Camera(object):
         rz = math.cos(math.pi / 2)
         self.right = np.array([rx, ry, rz])
 
-        Camera.log.debug("Pitch: {} [rad]; Yaw: {} [rad]".format(self.pitch, self.yaw))
-        Camera.log.debug("Facing: {} [unitless]".format(self.facing))
-        Camera.log.debug("Up    : {} [unitless]".format(self.up))
-        Camera.log.debug("Right : {} [unitless]".format(self.right))
+        tracer.record("camera", "direction", self.pitch, self.yaw, self.facing, self.up, self.right)
 
     def point_towards_target(self, target_coord):
-        Camera.log.debug("Facing target coordinate {}".format(target_coord.pos))
+        tracer.record("camera", "point_towards_target", target_coord.pos)
         coord = Coordinate(self.origin.pos + self.displacement.pos, self.origin.vel + self.displacement.vel)
         distance, target_vector = Coordinate.get_distance_and_radius_vector(coord, target_coord)
         normalized_vector = target_vector / distance
@@ -103,12 +101,11 @@ class Camera(object):
         yaw = math.acos(Camera.clean_cos(normalized_vector[0] / math.sin(pitch)))
         self.pitch = pitch
         self.yaw = yaw
-        Camera.log.debug("New Pitch, Yaw = {}, {}".format(self.pitch, self.yaw))
         self.get_direction_vectors()
         self.update_background = True
 
     def set_origin(self, coord):
-        Camera.log.debug("Setting origin to {}".format(coord.pos))
+        tracer.record("camera", "set_origin", coord.pos)
         self.origin.pos = coord.pos + np.array([0, 500, 0])
 
     def camera_has_moved(self):
@@ -122,53 +119,90 @@ class Camera(object):
     def get_apparent_radius_and_draw_pos(self, target_coord, target_radius):
 
         # If the target is not visible, return no radius and no position
-        def not_visible():
+        def not_visible(reason):
+            tracer.record("camera", reason, target_coord.pos, distance, face_dot_radius)
             return 0, None
 
         # Calculate the vector that points from the camera to the target
         coord = Coordinate(self.origin.pos + self.displacement.pos, self.origin.vel + self.displacement.vel)
-        Camera.log.debug("Camera Pos: {} [m]; Target Pos: {} [m]".format(coord.pos, target_coord.pos))
         distance, vector_to_coord = Coordinate.get_distance_and_radius_vector(coord, target_coord)
-        Camera.log.debug("Distance: {} Radius: {}".format(distance, vector_to_coord))
 
         # Calculate the component of the target vector that is parallel to the facing vector
         face_dot_radius = np.dot(self.facing, vector_to_coord)
-        Camera.log.debug("Face.radius: {} [m**2]; distance: {} [m]".format(face_dot_radius, distance))
 
         # If the facing vector dotted with the target vector is negative,
         # the target is behind the camera.  Return to save time.
         if face_dot_radius < 0:
-            return not_visible()
+            return not_visible("behind_camera")
 
         # Calculate the apparent angular distance from the facing vector
         # to the target vector
         apparent_angle = math.acos(Camera.clean_cos(face_dot_radius / distance))
-        Camera.log.debug("Apparent angle away from center: {} [rad]".format(apparent_angle))
 
         # Return if the target is outside the field of view
         if self.field_of_view < apparent_angle:
-            return not_visible()
+            return not_visible("outside_field_of_view")
 
         # Calculate the apparent size of the target object
-        Camera.log.debug("Target Radius: {} [m]".format(target_radius))
         if target_radius < distance:
             apparent_solid_angle = math.asin((target_radius / distance))
         else:
             apparent_solid_angle = math.pi / 3.0
 
         # Determine the apparent size of the target object
-        Camera.log.debug("Apparent Solid Angle: {} [rad]".format(apparent_solid_angle))
         apparent_target_radius = (apparent_solid_angle / self.field_of_view) * self.screen_diagonal
-        Camera.log.debug("Target's Screen Radius: {}".format(apparent_target_radius))
 
         # If we've made it this far, calculate the position of the target
         vector_scale = self.projection_plane_distance / face_dot_radius
         projection = vector_scale * (vector_to_coord - ((face_dot_radius / distance) * self.facing))
         x = (self.screen_dims[0] / 2) + np.dot(projection, self.right)
         y = (self.screen_dims[1] / 2) + np.dot(projection, self.up)
+        tracer.record("camera", "projected", target_coord.pos, distance, apparent_angle,
+                      target_radius, apparent_target_radius, x, y)
 
         return apparent_target_radius, np.round(np.array([x, y])).astype(int)
 
+    def project(self, positions, radii):
+        """
+        Projects an (N, 3) array of positions with their radii in one
+        pass.  Returns the apparent radii, the (N, 2) integer screen
+        positions and a mask of the targets in front of the camera and
+        inside the field of view, culled the same way as
+        get_apparent_radius_and_draw_pos.  Culled targets get a radius
+        of 0 and a screen position of (0, 0).
+        """
+        positions = np.asarray(positions, dtype=float).reshape(-1, 3)
+        radii = np.broadcast_to(np.asarray(radii, dtype=float), (len(positions),))
+        apparent_radii = np.zeros(len(positions))
+        screen_pos = np.zeros((len(positions), 2), dtype=int)
+
+        vectors = positions - (self.origin.pos + self.displacement.pos)
+        distances = np.sqrt(np.einsum('ij,ij->i', vectors, vectors))
+        face_dot_radius = vectors.dot(self.facing)
+
+        # behind the camera, or outside the field of view
+        visible = (0 <= face_dot_radius) & (0 < distances)
+        cos_angle = np.ones(len(positions))
+        cos_angle[visible] = np.clip(face_dot_radius[visible] / distances[visible], -1, 1)
+        visible &= np.arccos(cos_angle) <= self.field_of_view
+        tracer.record("camera", "project", len(positions), np.count_nonzero(visible))
+
+        vectors, distances, face_dot_radius = vectors[visible], distances[visible], face_dot_radius[visible]
+        cos_angle, target_radii = cos_angle[visible], radii[visible]
+
+        # apparent size, saturating when the camera is inside the target
+        apparent_solid_angle = np.full(len(distances), math.pi / 3.0)
+        inside = target_radii < distances
+        apparent_solid_angle[inside] = np.arcsin(target_radii[inside] / distances[inside])
+        apparent_radii[visible] = (apparent_solid_angle / self.field_of_view) * self.screen_diagonal
+
+        vector_scale = self.projection_plane_distance / face_dot_radius
+        projections = vector_scale[:, np.newaxis] * (vectors - cos_angle[:, np.newaxis] * self.facing)
+        screen_pos[visible, 0] = np.round((self.screen_dims[0] / 2) + projections.dot(self.right))
+        screen_pos[visible, 1] = np.round((self.screen_dims[1] / 2) + projections.dot(self.up))
+
+        return apparent_radii, screen_pos, visible
+
     def move_backward(self):
         self.camera_has_moved()
         self.displacement.pos -= self.zoom_multiplier * self.zoom_rate * self.facing
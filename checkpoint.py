@@ -0,0 +1,95 @@
+__author__ = 'charles.andrew.parker@gmail.com'
+
+import json
+import logging
+import os
+import numpy as np
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+VERSION = 1
+
+
+def to_json(value):
+    """
+    For json.dumps: numpy arrays and scalars as plain lists and numbers.
+    """
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError("{!r} cannot be saved in a checkpoint".format(value))
+
+
+def get_rng_state(rng, np_rng):
+    """
+    The state of a random.Random and a numpy RandomState,
+    as JSON-able values and arrays.
+    """
+    version, internal, gauss_next = rng.getstate()
+    name, keys, pos, has_gauss, cached_gaussian = np_rng.get_state()
+    meta = {"random": [version, gauss_next],
+            "numpy_random": [name, int(pos), int(has_gauss), float(cached_gaussian)]}
+    arrays = {"random_state": np.array(internal, dtype=np.uint64),
+              "numpy_random_keys": np.asarray(keys, dtype=np.uint32)}
+    return meta, arrays
+
+
+def set_rng_state(meta, arrays, rng, np_rng):
+    version, gauss_next = meta["random"]
+    rng.setstate((version, tuple(int(k) for k in arrays["random_state"]), gauss_next))
+    name, pos, has_gauss, cached_gaussian = meta["numpy_random"]
+    np_rng.set_state((str(name), arrays["numpy_random_keys"], pos, has_gauss, cached_gaussian))
+
+
+def get_state(owner, prefix):
+    """
+    The attributes an integrator or solver carries from step to step,
+    listed in its state_attributes: arrays apart, named with prefix,
+    everything else as JSON.
+    """
+    meta, arrays = {}, {}
+    for name in owner.state_attributes:
+        value = getattr(owner, name)
+        if isinstance(value, np.ndarray):
+            arrays[prefix + name] = value
+        else:
+            meta[name] = value
+    return meta, arrays
+
+
+def set_state(owner, meta, arrays, prefix):
+    for name in owner.state_attributes:
+        if prefix + name in arrays:
+            setattr(owner, name, arrays[prefix + name].copy())
+        else:
+            setattr(owner, name, meta.get(name))
+
+
+def write_checkpoint(path, meta, arrays):
+    """
+    Saves a checkpoint as a compressed .npz of the arrays plus the
+    JSON-encoded meta.  It is written beside path and renamed over
+    it once synced, so a crash mid-write leaves the last checkpoint.
+    """
+    meta = dict(meta, version=VERSION)
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as f:
+        np.savez_compressed(f, meta=np.array(json.dumps(meta, default=to_json)), **arrays)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(temp_path, path)
+    log.info("Wrote checkpoint {}".format(path))
+
+
+def read_checkpoint(path):
+    """
+    The meta and arrays of a checkpoint made by write_checkpoint.
+    """
+    with np.load(path) as data:
+        arrays = dict((name, data[name]) for name in data.files if name != "meta")
+        meta = json.loads(str(data["meta"]))
+    if meta.get("version") != VERSION:
+        raise ValueError("Unsupported checkpoint version {} in {}".format(meta.get("version"), path))
+    return meta, arrays
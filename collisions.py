@@ -0,0 +1,145 @@
+__author__ = 'charles.andrew.parker@gmail.com'
+
+import logging
+import numpy as np
+from solvers import spatialhash
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+
+def get_spatial_hash_pairs(pos, radius):
+    """
+    Overlapping pairs from a uniform grid whose cells
+    are as wide as the largest bounding sphere.
+    """
+    return spatialhash.get_overlapping_pairs(pos, radius)
+
+
+def get_sweep_and_prune_pairs(pos, radius, max_pairs=2 ** 22):
+    """
+    Overlapping pairs from sorting the bounding intervals along x.
+    Unlike the spatial hash this is not slowed down by a few bodies
+    much larger than the rest.
+    """
+    n = len(pos)
+    if n < 2:
+        return np.zeros((0, 2), dtype=int)
+
+    lo = pos[:, 0] - radius
+    hi = pos[:, 0] + radius
+    order = np.argsort(lo, kind='mergesort')
+    sorted_lo = lo[order]
+
+    # sorted body k overlaps along x with every later body that starts before it ends
+    first = np.arange(1, n + 1)
+    count = np.maximum(np.searchsorted(sorted_lo, hi[order], side='left') - first, 0)
+    bounds = np.cumsum(count)
+
+    found = []
+    start = 0
+    while start < n:
+        done = bounds[start - 1] if start > 0 else 0
+        stop = max(start + 1, int(np.searchsorted(bounds, done + max_pairs, side='right')))
+        batch = count[start:stop]
+        owner = np.repeat(np.arange(start, stop), batch)
+        other = np.repeat(first[start:stop], batch) + np.arange(int(batch.sum())) - \
+            np.repeat(np.cumsum(batch) - batch, batch)
+        i, j = order[owner], order[other]
+        vect = pos[j] - pos[i]
+        touching = np.einsum('ij,ij->i', vect, vect) < (radius[i] + radius[j]) ** 2
+        found.append(np.column_stack((np.minimum(i, j), np.maximum(i, j)))[touching])
+        start = stop
+
+    return np.concatenate(found)
+
+
+def get_brute_force_pairs(pos, radius):
+    """
+    Overlapping pairs from testing every pair, which is cheapest
+    for a handful of bodies.
+    """
+    i, j = np.triu_indices(len(pos), 1)
+    vect = pos[j] - pos[i]
+    touching = np.einsum('ij,ij->i', vect, vect) < (radius[i] + radius[j]) ** 2
+    return np.column_stack((i[touching], j[touching]))
+
+
+BRUTE_FORCE_LIMIT = 64
+
+BROADPHASES = {
+    "spatial_hash": get_spatial_hash_pairs,
+    "sweep_and_prune": get_sweep_and_prune_pairs,
+}
+
+
+def get_broadphase(sim_config):
+    name = sim_config.get("collision_broadphase", "sweep_and_prune")
+    if name not in BROADPHASES:
+        raise ValueError("Unknown collision broadphase {}; expected one of {}".format(name, sorted(BROADPHASES)))
+    return BROADPHASES[name]
+
+
+def find_overlapping_pairs(pos, radius, broadphase):
+    """
+    Returns the (M, 2) index pairs, i < j, of bodies whose radii overlap.
+    """
+    if len(pos) <= BRUTE_FORCE_LIMIT:
+        return get_brute_force_pairs(pos, radius)
+    return broadphase(pos, radius)
+
+
+def get_groups(num_bodies, pairs):
+    """
+    Labels every body with the lowest index of the group of
+    bodies it is transitively touching.
+    """
+    labels = np.arange(num_bodies)
+    if len(pairs) == 0:
+        return labels
+
+    i, j = pairs[:, 0], pairs[:, 1]
+    while True:
+        lowest = np.minimum(labels[i], labels[j])
+        merged = labels.copy()
+        np.minimum.at(merged, i, lowest)
+        np.minimum.at(merged, j, lowest)
+        merged = merged[merged]
+        if (merged == labels).all():
+            return labels
+        labels = merged
+
+
+def merge_groups(mass, vel, pairs):
+    """
+    Merges every connected group of overlapping bodies into its most
+    massive member, which takes the group's total mass and momentum.
+    mass and vel are updated in place.  Returns the indices of the
+    survivors and of the absorbed bodies.
+    """
+    labels = get_groups(len(mass), pairs)
+    members = np.nonzero(labels != np.arange(len(mass)))[0]
+    if len(members) == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+
+    in_group = np.zeros(len(mass), dtype=bool)
+    in_group[members] = True
+    in_group[labels[members]] = True
+    rows = np.nonzero(in_group)[0]
+    groups = labels[rows]
+
+    # survivor: heaviest member, the later one on a tie
+    order = np.lexsort((rows, mass[rows], groups))
+    last_of_group = np.append(groups[order][1:] != groups[order][:-1], True)
+    survivors = rows[order][last_of_group]
+
+    total_mass = np.bincount(groups, weights=mass[rows], minlength=len(mass))
+    momentum = np.column_stack([np.bincount(groups, weights=mass[rows] * vel[rows, k],
+                                            minlength=len(mass)) for k in range(3)])
+    roots = labels[survivors]
+    vel[survivors] = momentum[roots] / total_mass[roots][:, np.newaxis]
+    mass[survivors] = total_mass[roots]
+
+    absorbed = np.setdiff1d(rows, survivors)
+    log.debug("Merged {} bodies into {}".format(len(absorbed), len(survivors)))
+    return survivors, absorbed
@@ -1,5 +1,6 @@
 __author__ = 'charles'
 
+from tracing import tracer
 import logging
 import numpy as np
 import random
@@ -27,9 +28,9 @@ class Coordinate(object):
         return np.array([0.0 for _ in range(cls.DIMENSIONS)])
 
     @classmethod
-    def get_random_coordinate(cls, radius_from_zero):
-        pitch = random.sample(np.arange(1 * math.pi / 8, 7 * math.pi / 8, math.pi/180), 1)[0]
-        yaw = random.sample(np.arange(0, 2 * math.pi, math.pi/180), 1)[0]
+    def get_random_coordinate(cls, radius_from_zero, rng=random):
+        pitch = rng.sample(np.arange(1 * math.pi / 8, 7 * math.pi / 8, math.pi/180), 1)[0]
+        yaw = rng.sample(np.arange(0, 2 * math.pi, math.pi/180), 1)[0]
         x = radius_from_zero * math.sin(pitch) * math.cos(yaw)
         y = radius_from_zero * math.sin(pitch) * math.sin(yaw)
         z = radius_from_zero * math.cos(pitch)
@@ -44,30 +45,106 @@ class Coordinate(object):
             return np.array(coord)
 
     def __init__(self, pos, vel):
-        self.pos = Coordinate.validate_coordinate(pos)
-        self.vel = Coordinate.validate_coordinate(vel)
-        self.acc = Coordinate.get_empty_coord()
+        self.store = None
+        self.index = None
+        self._pos = Coordinate.validate_coordinate(pos)
+        self._vel = Coordinate.validate_coordinate(vel)
+        self._acc = Coordinate.get_empty_coord()
+
+    def bind(self, store, index):
+        """
+        Makes this coordinate a view into row `index` of a BodyStore.
+        The store is expected to already hold this coordinate's state.
+        """
+        self.store = store
+        self.index = index
+
+    def unbind(self):
+        """
+        Detaches this coordinate from its store, keeping a copy
+        of the state it had in the store.
+        """
+        if self.store is not None:
+            self._pos = self.pos.copy()
+            self._vel = self.vel.copy()
+            self._acc = self.acc.copy()
+            self.store = None
+            self.index = None
+
+    def __getstate__(self):
+        return {"store": None,
+                "index": None,
+                "_pos": np.array(self.pos),
+                "_vel": np.array(self.vel),
+                "_acc": np.array(self.acc)}
+
+    def __setstate__(self, state):
+        # Recordings made before the body store existed pickled
+        # the arrays directly as pos/vel/acc
+        for name in ("pos", "vel", "acc"):
+            if name in state:
+                state["_" + name] = state.pop(name)
+        state.setdefault("store", None)
+        state.setdefault("index", None)
+        self.__dict__.update(state)
+
+    @property
+    def pos(self):
+        if self.store is None:
+            return self._pos
+        return self.store.pos[self.index]
+
+    @pos.setter
+    def pos(self, value):
+        if self.store is None:
+            self._pos = value
+        else:
+            self.store.pos[self.index] = value
+
+    @property
+    def vel(self):
+        if self.store is None:
+            return self._vel
+        return self.store.vel[self.index]
+
+    @vel.setter
+    def vel(self, value):
+        if self.store is None:
+            self._vel = value
+        else:
+            self.store.vel[self.index] = value
+
+    @property
+    def acc(self):
+        if self.store is None:
+            return self._acc
+        return self.store.acc[self.index]
+
+    @acc.setter
+    def acc(self, value):
+        if self.store is None:
+            self._acc = value
+        else:
+            self.store.acc[self.index] = value
 
     def update_pos(self, dt):
-        log.debug("Initial pos {}; vel {}".format(self.pos, self.vel))
+        tracer.record("coordinate", "update_pos", self.pos, self.vel, dt)
         self.pos = self.pos + dt * self.vel
-        log.debug("Final pos {}".format(self.pos))
 
     def update_vel(self, dt):
-        log.debug("Initial vel {}".format(self.vel))
+        tracer.record("coordinate", "update_vel", self.vel, self.acc, dt)
         self.vel = self.vel + dt * self.acc
-        log.debug("Final vel {}".format(self.vel))
 
     def set_acc(self, acc):
-        log.debug("Changing acceleration to {}".format(acc))
+        tracer.record("coordinate", "set_acc", acc)
         self.acc = acc
 
     def update_acc(self, acc):
         self.acc += acc
-        log.debug("Updating acceleration to {}".format(self.acc))
+        tracer.record("coordinate", "update_acc", self.acc)
 
     def zero_acc(self):
-        log.debug("Setting acceleration to <0.0>")
+        tracer.record("coordinate", "zero_acc")
         self.acc = Coordinate.get_empty_coord()
 
     def get_speed(self):
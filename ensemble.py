@@ -0,0 +1,126 @@
+__author__ = 'charles.andrew.parker@gmail.com'
+
+from objects import body
+import integrators
+import collisions
+import logging
+import numpy as np
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+
+def accumulate_ensemble_accelerations(pos, mass, alive, big_g, out, max_block_elements=2 ** 22):
+    """
+    Exact pairwise accelerations for K independent systems at once.
+    pos is (K, N, 3) and mass/alive are (K, N); bodies that are not
+    alive neither feel nor exert any force.
+    """
+    num_members, num_bodies = mass.shape
+    block = max(1, max_block_elements // max(3 * num_bodies ** 2, 1))
+    diagonal = np.eye(num_bodies, dtype=bool)
+
+    for start in range(0, num_members, block):
+        stop = min(start + block, num_members)
+        vect = pos[start:stop, np.newaxis, :, :] - pos[start:stop, :, np.newaxis, :]
+        dist_sq = np.einsum('kijd,kijd->kij', vect, vect)
+        dist_sq[:, diagonal] = np.inf
+        dist_sq[~alive[start:stop, np.newaxis, :].repeat(num_bodies, axis=1)] = np.inf
+
+        weights = mass[start:stop, np.newaxis, :] / (dist_sq * np.sqrt(dist_sq))
+        out[start:stop] = big_g * np.einsum('kij,kijd->kid', weights, vect)
+        out[start:stop][~alive[start:stop]] = 0.0
+
+
+class GravityEnsemble(object):
+    """
+    K independent simulations with the same number of bodies, stacked
+    along an extra leading array axis and advanced together.
+
+    Bodies removed by collisions are masked out per member rather than
+    compacted, so every member keeps the same shape.  The ensemble
+    offers the same update methods as GravitySimulation, so the
+    single-state integrators (euler, leapfrog, yoshida4) drive it
+    unchanged.
+    """
+
+    INTEGRATORS = (integrators.EulerIntegrator, integrators.LeapfrogIntegrator)
+
+    def __init__(self, member_configs, sim_config):
+        self.sim_config = sim_config
+        self.BIG_G = sim_config["gravitational_constant"]
+        self.integrator = integrators.get_integrator(sim_config)
+        if not isinstance(self.integrator, GravityEnsemble.INTEGRATORS):
+            raise ValueError("Integrator {} cannot advance an ensemble".format(self.integrator.name))
+
+        sizes = set(len(configs) for configs in member_configs)
+        if len(sizes) != 1:
+            raise ValueError("Every ensemble member needs the same number of bodies, got {}".format(sorted(sizes)))
+
+        self.names = [p["name"] for p in member_configs[0]]
+        self.colors = [[p["color"] for p in configs] for configs in member_configs]
+        self.pos = np.array([[p["pos"] for p in configs] for configs in member_configs], dtype=float)
+        self.vel = np.array([[p["vel"] for p in configs] for configs in member_configs], dtype=float)
+        self.mass = np.array([[p["mass"] for p in configs] for configs in member_configs], dtype=float)
+        self.acc = np.zeros_like(self.pos)
+        self.alive = np.ones(self.mass.shape, dtype=bool)
+        self.radius = body.Planet.get_radius_for_mass(self.mass)
+        self.collisions = np.zeros((0, 2), dtype=int)
+        self.accelerations_current = False
+
+    def __len__(self):
+        return len(self.mass)
+
+    def update_distance_and_vectors_for_planets(self):
+        """
+        Finds overlapping pairs of live bodies in every member, as
+        (i, j) pairs of flat indices into the (K * N) bodies.
+        """
+        num_members, num_bodies = self.mass.shape
+        i, j = np.triu_indices(num_bodies, 1)
+        vect = self.pos[:, j] - self.pos[:, i]
+        touching = np.einsum('kpd,kpd->kp', vect, vect) < (self.radius[:, i] + self.radius[:, j]) ** 2
+        touching &= self.alive[:, i] & self.alive[:, j]
+        member, pair = np.nonzero(touching)
+        self.collisions = np.column_stack((member * num_bodies + i[pair], member * num_bodies + j[pair]))
+
+    def handle_collisions(self):
+        if len(self.collisions) == 0:
+            return
+        mass = self.mass.reshape(-1)
+        survivors, absorbed = collisions.merge_groups(mass, self.vel.reshape(-1, 3), self.collisions)
+        self.radius.reshape(-1)[survivors] = body.Planet.get_radius_for_mass(mass[survivors])
+
+        self.alive.reshape(-1)[absorbed] = False
+        mass[absorbed] = 0.0
+        self.vel.reshape(-1, 3)[absorbed] = 0.0
+        self.accelerations_current = False
+
+    def update_positions(self, dt):
+        self.pos += dt * self.vel
+
+    def update_velocities(self, dt):
+        self.vel += dt * self.acc
+
+    def update_acceleration(self):
+        accumulate_ensemble_accelerations(self.pos, self.mass, self.alive, self.BIG_G, self.acc)
+        self.accelerations_current = True
+
+    def update_planets(self, dt):
+        log.info("UPDATING DISTANCES AND RADIUS VECTORS")
+        self.update_distance_and_vectors_for_planets()
+        log.info("HANDLING COLLISIONS")
+        self.handle_collisions()
+        log.info("INTEGRATING")
+        self.integrator.step(self, dt)
+
+    def get_member_state(self, member):
+        """
+        The live bodies of one member as a list of planet configs.
+        """
+        return [{"name": name,
+                 "pos": self.pos[member, i].copy(),
+                 "vel": self.vel[member, i].copy(),
+                 "mass": self.mass[member, i],
+                 "color": self.colors[member][i]}
+                for i, name in enumerate(self.names) if self.alive[member, i]]
@@ -0,0 +1,192 @@
+__author__ = 'charles.andrew.parker@gmail.com'
+
+import logging
+import numpy as np
+import pygame
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+
+def get_disc_offsets(radius):
+    """
+    The (dx, dy) pixel offsets pygame.draw.circle fills
+    for a disc of the given integer radius.
+    """
+    size = 2 * radius + 3
+    surface = pygame.Surface((size, size))
+    pygame.draw.circle(surface, (255, 255, 255), (radius + 1, radius + 1), radius, 0)
+    dx, dy = np.nonzero(pygame.surfarray.array2d(surface))
+    return dx - (radius + 1), dy - (radius + 1)
+
+
+class FramebufferRenderer(object):
+    """
+    Draws bodies by writing straight into the surface's pixel array
+    instead of one pygame call per body.  Each body is drawn at a
+    level of detail chosen from its apparent radius:
+
+      - below framebuffer_point_radius it is splatted into a single
+        pixel, weighted by its apparent area and added to what is
+        already there, so dense clusters build up brightness;
+      - up to framebuffer_max_disc_radius it is stamped as a disc with
+        exactly the pixels pygame.draw.circle would fill, farthest
+        first so the nearest body wins where discs overlap;
+      - anything larger is handed to pygame.draw.circle, in between
+        the smaller bodies behind and in front of it.
+
+    Spheres of influence are drawn for disc-sized bodies only, each
+    straight after its body as the circle renderer does, so nearer
+    bodies cover them.
+    """
+
+    def __init__(self, sim_config):
+        self.point_radius = sim_config.get("framebuffer_point_radius", 1.0)
+        self.max_disc_radius = sim_config.get("framebuffer_max_disc_radius", 64)
+        self.discs = {}
+        self.colors = None
+        self.zbuf = None
+
+    def get_disc(self, radius):
+        if radius not in self.discs:
+            self.discs[radius] = get_disc_offsets(radius)
+        return self.discs[radius]
+
+    def get_zbuf(self, width, height):
+        """
+        The depth of the nearest disc at every pixel, kept between
+        frames; whatever a layer writes it puts back to infinity.
+        """
+        if self.zbuf is None or len(self.zbuf) != width * height:
+            self.zbuf = np.full(width * height, np.inf)
+        return self.zbuf
+
+    def get_colors(self, store):
+        """
+        The bodies' colors as an (N, 3) array, rebuilt only when
+        bodies are added to or removed from the store.
+        """
+        if self.colors is None or self.colors[0] is not store.bodies or len(self.colors[1]) != len(store):
+            self.colors = (store.bodies, np.array([b.color for b in store.bodies], dtype=float).reshape(-1, 3))
+        return self.colors[1]
+
+    def draw(self, surface, camera, store, draw_soi=False):
+        """
+        Draws every body in the store.  Returns the number of
+        bodies drawn as points and as discs.
+        """
+        if surface.get_bytesize() < 3:
+            raise ValueError("The framebuffer renderer needs a 24 or 32 bit surface, got {} bits".format(
+                surface.get_bitsize()))
+        width, height = surface.get_size()
+        colors = self.get_colors(store)
+        r, screen_pos, visible = camera.project(store.pos, store.radius)
+        vect = store.pos - camera.coord.pos
+        depth = np.sqrt(np.einsum('ij,ij->i', vect, vect))
+
+        on_screen = visible & (-r < screen_pos[:, 0]) & (screen_pos[:, 0] < width + r) & \
+            (-r < screen_pos[:, 1]) & (screen_pos[:, 1] < height + r)
+        points = np.nonzero(on_screen & (r < self.point_radius))[0]
+        disc_radius = np.round(r).astype(int)
+        discs = np.nonzero(on_screen & (self.point_radius <= r) & (disc_radius <= self.max_disc_radius))[0]
+        large = np.nonzero(on_screen & (self.point_radius <= r) & (self.max_disc_radius < disc_radius))[0]
+
+        # the few large discs and spheres of influence are painted
+        # farthest first, each after the smaller bodies behind it
+        events = [(large, np.zeros(len(large), dtype=int))]
+        sized = np.nonzero(visible & (self.point_radius <= r))[0]
+        if draw_soi is True and len(sized):
+            soi = np.array([store.bodies[i].get_sphere_of_influence() for i in sized], dtype=float)
+            soi_r, soi_pos, soi_visible = camera.project(store.pos[sized], soi)
+            soi_r, soi_pos = dict(zip(sized, soi_r)), dict(zip(sized, soi_pos.tolist()))
+            events.append((sized[soi_visible], np.ones(np.count_nonzero(soi_visible), dtype=int)))
+        event_body = np.concatenate([e[0] for e in events])
+        event_soi = np.concatenate([e[1] for e in events])
+        # a body's own sphere of influence goes after its disc
+        order = np.lexsort((event_soi, -depth[event_body]))
+        event_body, event_soi = event_body[order], event_soi[order]
+        discs_by_layer = self.split_layers(discs, depth, event_body)
+        points_by_layer = self.split_layers(points, depth, event_body)
+
+        zbuf = self.get_zbuf(width, height)
+        for layer in range(len(event_body) + 1):
+            if len(discs_by_layer[layer]) or len(points_by_layer[layer]):
+                pixels = pygame.surfarray.pixels3d(surface)
+                disc_pixels = self.draw_discs(pixels, zbuf, discs_by_layer[layer], disc_radius,
+                                              screen_pos, depth, colors)
+                self.draw_points(pixels, zbuf, points_by_layer[layer], r, screen_pos, depth, colors)
+                zbuf[disc_pixels] = np.inf
+                del pixels
+            if layer < len(event_body):
+                i = event_body[layer]
+                if event_soi[layer]:
+                    store.bodies[i].draw_sphere_of_influence_projected(surface, soi_r[i], soi_pos[i])
+                else:
+                    pygame.draw.circle(surface, store.bodies[i].color, screen_pos[i], disc_radius[i], 0)
+
+        return len(points), len(discs) + len(large)
+
+    @staticmethod
+    def split_layers(bodies, depth, event_body):
+        """
+        Splits bodies into the len(event_body) + 1 layers between the
+        events, which are sorted farthest first.
+        """
+        layer = np.searchsorted(-depth[event_body], -depth[bodies], side='left')
+        order = np.argsort(layer, kind='mergesort')
+        return np.split(bodies[order], np.searchsorted(layer[order], np.arange(1, len(event_body) + 1)))
+
+    def draw_discs(self, pixels, zbuf, discs, disc_radius, screen_pos, depth, colors):
+        """
+        Stamps the discs farthest first, so the nearest is written last
+        where they overlap, and records each covered pixel's depth in
+        zbuf.  Only the discs are sorted, never their pixels.  Returns
+        the flat indices of the pixels covered.
+        """
+        width, height = pixels.shape[:2]
+        if len(discs) == 0:
+            return np.zeros(0, dtype=int)
+
+        discs = discs[np.argsort(-depth[discs], kind='mergesort')]
+        radii = np.unique(disc_radius[discs])
+        offsets = [self.get_disc(int(radius)) for radius in radii]
+        sizes = np.array([len(dx) for dx, _ in offsets])
+        dx = np.concatenate([o[0] for o in offsets])
+        dy = np.concatenate([o[1] for o in offsets])
+        # each disc's pixels in turn, read from its radius's offsets
+        which = np.searchsorted(radii, disc_radius[discs])
+        counts = sizes[which]
+        owner = np.repeat(discs, counts)
+        offset = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        offset += np.repeat((np.cumsum(sizes) - sizes)[which], counts)
+        x = screen_pos[owner, 0] + dx[offset]
+        y = screen_pos[owner, 1] + dy[offset]
+
+        inside = (0 <= x) & (x < width) & (0 <= y) & (y < height)
+        x, y, owner = x[inside], y[inside], owner[inside]
+        flat = x * height + y
+        pixels[x, y] = colors[owner]
+        zbuf[flat] = depth[owner]
+        return flat
+
+    def draw_points(self, pixels, zbuf, points, r, screen_pos, depth, colors):
+        """
+        Adds each sub-pixel body's color, weighted by its apparent
+        area, to its pixel unless a nearer disc covers it.
+        """
+        width, height = pixels.shape[:2]
+        x, y = screen_pos[points, 0], screen_pos[points, 1]
+        inside = (0 <= x) & (x < width) & (0 <= y) & (y < height)
+        points, x, y = points[inside], x[inside], y[inside]
+        flat = x * height + y
+
+        hidden = zbuf[flat] < depth[points]
+        points, flat = points[~hidden], flat[~hidden]
+        if len(points) == 0:
+            return
+
+        weight = (r[points] / self.point_radius) ** 2
+        touched, index = np.unique(flat, return_inverse=True)
+        light = np.column_stack([np.bincount(index, weights=weight * colors[points, k]) for k in range(3)])
+        tx, ty = touched // height, touched % height
+        pixels[tx, ty] = np.minimum(pixels[tx, ty] + light, 255)
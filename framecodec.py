@@ -0,0 +1,155 @@
+__author__ = 'charles.andrew.parker@gmail.com'
+
+import json
+import logging
+import struct
+import zlib
+import numpy as np
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+CHUNK_MAGIC = "GRCK"
+CHUNK_HEADER = struct.Struct("<4sIQ")
+
+
+def get_narrowest_int_dtype(values):
+    """
+    The smallest signed integer type that holds every value.
+    """
+    if len(values) == 0:
+        return np.dtype(np.int8)
+    low, high = values.min(), values.max()
+    for dtype in (np.int8, np.int16, np.int32):
+        info = np.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+
+def get_position_steps(vel_q, sim_time, position_precision, velocity_precision):
+    """
+    The predicted move between consecutive frames, in steps of
+    position_precision: the mean of the quantized velocities at
+    either end times the time between the frames.
+    """
+    dt = np.diff(sim_time)[:, np.newaxis, np.newaxis]
+    mean_vel = (vel_q[1:] + vel_q[:-1]) * (0.5 * velocity_precision)
+    return np.round(mean_vel * dt / position_precision).astype(np.int64)
+
+
+def get_step_runs(steps):
+    """
+    The steps of consecutive frames as [first, stride, count] runs of
+    evenly spaced steps: one run, unless frames were dropped.
+    """
+    runs = []
+    for step in np.asarray(steps).tolist():
+        if runs and runs[-1][2] == 1 and runs[-1][0] < step:
+            runs[-1][1:] = [step - runs[-1][0], 2]
+        elif runs and runs[-1][0] + runs[-1][1] * runs[-1][2] == step:
+            runs[-1][2] += 1
+        else:
+            runs.append([step, 0, 1])
+    return runs
+
+
+def get_steps(runs):
+    """
+    The steps listed by get_step_runs.
+    """
+    if len(runs) == 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate([first + stride * np.arange(count, dtype=np.int64) for first, stride, count in runs])
+
+
+def get_bits(values):
+    return np.ascontiguousarray(values, dtype="<f8").view(np.int64)
+
+
+def encode_chunk(frames, position_precision, velocity_precision, level=6):
+    """
+    Encodes consecutive frames of a recording as one chunk.
+
+    The first frame is a keyframe.  Velocities are quantized to
+    velocity_precision and stored as the change from the frame
+    before; positions are quantized to position_precision and stored
+    as the difference from where the mean velocity predicts they will
+    be.  Masses and radii are kept exactly, as the change in their
+    bit patterns.  The small residuals are packed into the narrowest
+    integer type and the whole chunk is deflated.
+    """
+    vel_q = np.round(frames["vel"] / velocity_precision).astype(np.int64)
+    pos_q = np.round(frames["pos"] / position_precision).astype(np.int64)
+    pos_residual = np.diff(pos_q, axis=0) - get_position_steps(vel_q, frames["sim_time"],
+                                                               position_precision, velocity_precision)
+    columns = [("vel", vel_q, np.diff(vel_q, axis=0)),
+               ("pos", pos_q, pos_residual),
+               ("mass", get_bits(frames["mass"]), np.diff(get_bits(frames["mass"]), axis=0)),
+               ("radius", get_bits(frames["radius"]), np.diff(get_bits(frames["radius"]), axis=0)),
+               ("alive", frames["alive"].astype(np.int64), np.diff(frames["alive"].astype(np.int64), axis=0))]
+
+    arrays = [("step", np.ascontiguousarray(frames["step"], dtype="<i8")),
+              ("sim_time", np.ascontiguousarray(frames["sim_time"], dtype="<f8"))]
+    for name, values, residual in columns:
+        arrays.append(("key_" + name, values[0].astype("<i8")))
+        arrays.append((name, residual.astype(get_narrowest_int_dtype(residual).newbyteorder("<"))))
+
+    layout = {"frames": len(frames),
+              "step_runs": get_step_runs(frames["step"]),
+              "arrays": [[name, a.dtype.str, list(a.shape)] for name, a in arrays]}
+    text = json.dumps(layout)
+    payload = zlib.compress("".join(a.tobytes() for _, a in arrays), level)
+    return CHUNK_HEADER.pack(CHUNK_MAGIC, len(text), len(payload)) + text + payload
+
+
+def read_chunk_header(data):
+    """
+    The length of a chunk's layout and of its payload.
+    """
+    magic, text_length, payload_length = CHUNK_HEADER.unpack(data[:CHUNK_HEADER.size])
+    if magic != CHUNK_MAGIC:
+        raise ValueError("Not a recording chunk (magic {!r})".format(magic))
+    return text_length, payload_length
+
+
+def decode_chunk(data, dtype, position_precision, velocity_precision):
+    """
+    The frames of a chunk made by encode_chunk, as an array of dtype.
+    """
+    text_length, payload_length = read_chunk_header(data)
+    start = CHUNK_HEADER.size
+    layout = json.loads(data[start:start + text_length])
+    payload = zlib.decompress(data[start + text_length:start + text_length + payload_length])
+
+    arrays = {}
+    offset = 0
+    for name, dtype_str, shape in layout["arrays"]:
+        a = np.frombuffer(payload, dtype=dtype_str, count=int(np.prod(shape)), offset=offset).reshape(shape)
+        arrays[name] = a
+        offset += a.nbytes
+
+    def accumulate(name):
+        residual = arrays[name].astype(np.int64)
+        values = np.empty((len(residual) + 1,) + residual.shape[1:], dtype=np.int64)
+        values[0] = arrays["key_" + name]
+        values[1:] = residual
+        return np.cumsum(values, axis=0)
+
+    frames = np.zeros(layout["frames"], dtype=dtype)
+    frames["step"] = arrays["step"]
+    frames["sim_time"] = arrays["sim_time"]
+    vel_q = accumulate("vel")
+    frames["vel"] = vel_q * velocity_precision
+
+    steps = get_position_steps(vel_q, arrays["sim_time"], position_precision, velocity_precision)
+    pos_residual = arrays["pos"].astype(np.int64) + steps
+    pos_q = np.empty_like(vel_q)
+    pos_q[0] = arrays["key_pos"]
+    pos_q[1:] = pos_residual
+    frames["pos"] = np.cumsum(pos_q, axis=0) * position_precision
+
+    frames["mass"] = accumulate("mass").view("<f8")
+    frames["radius"] = accumulate("radius").view("<f8")
+    frames["alive"] = accumulate("alive")
+    return frames
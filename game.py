@@ -4,6 +4,9 @@ __author__ = 'charles.andrew.parker@gmail.com'
 from objects import body
 import logging
 import itertools
+import sys
+import threading
+import time
 from coordinate import Coordinate
 from camera import Camera
 import pygame
@@ -71,15 +74,115 @@ class TimeWarp(object):
         return self.timestep ** self.timewarp_value
 
 
+class SimulationThread(threading.Thread):
+    """
+    Steps a simulation as fast as it will go, or at most
+    max_steps_per_second, publishing a snapshot after every step.
+
+    The latest complete snapshot is swapped in under a lock and never
+    written to again, so the renderer can draw it while the next one
+    is being built.  Anything else that changes the simulation from
+    another thread must hold step_lock.
+
+    If a step raises, the thread logs it and stops, and the error is
+    raised again on the drawing thread by the next get_snapshot().
+    """
+
+    PAUSED_POLL_SECONDS = 0.01
+
+    def __init__(self, sim, time_handler, max_steps_per_second=None):
+        threading.Thread.__init__(self, name="simulation")
+        self.daemon = True
+        self.sim = sim
+        self.time_handler = time_handler
+        self.min_step_seconds = 0.0 if max_steps_per_second is None else 1.0 / max_steps_per_second
+        self.step_lock = threading.Lock()
+        self.snapshot_lock = threading.Lock()
+        self.snapshot = sim.take_snapshot()
+        self.stopped = threading.Event()
+        self.error = None
+
+    def run(self):
+        try:
+            self.run_steps()
+        except Exception:
+            log.exception("Simulation thread failed")
+            self.error = sys.exc_info()
+
+    def run_steps(self):
+        while not self.stopped.is_set():
+            start = time.time()
+            if self.time_handler.paused is True:
+                self.stopped.wait(SimulationThread.PAUSED_POLL_SECONDS)
+                continue
+
+            with self.step_lock:
+                self.sim.update_planets(self.time_handler.get_timestep())
+                self.publish()
+
+            remaining = self.min_step_seconds - (time.time() - start)
+            if 0 < remaining:
+                self.stopped.wait(remaining)
+            else:
+                # let the drawing thread in between steps
+                time.sleep(0)
+
+    def publish(self):
+        snapshot = self.sim.take_snapshot()
+        with self.snapshot_lock:
+            self.snapshot = snapshot
+
+    def get_snapshot(self):
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        with self.snapshot_lock:
+            return self.snapshot
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
 class GravitySimulationSystem(object):
+    """
+    Runs a simulation for the interactive viewer.  By default step()
+    advances it once per frame; with sim_config["simulation_thread"]
+    set it advances continuously in a SimulationThread once start()
+    is called, and the latest snapshot is drawn every frame.
+    """
+
     def __init__(self, planet_configs, sim_config):
         self.sim = simulation.GravitySimulation(planet_configs, sim_config)
         self.time_handler = TimeWarp(1.3, 8)
+        self.worker = None
+        self.drawn_snapshot = None
+        if sim_config.get("simulation_thread", False) is True:
+            # trails are sampled from the snapshots as they are drawn
+            self.sim.sample_trails = False
+            self.worker = SimulationThread(self.sim, self.time_handler,
+                                           sim_config.get("max_steps_per_second", None))
+
+    def start(self):
+        if self.worker is not None and not self.worker.is_alive():
+            self.worker.start()
+
+    def stop(self):
+        if self.worker is not None and self.worker.is_alive():
+            self.worker.stop()
+        self.sim.close()
+
+    def reset(self):
+        if self.worker is None:
+            self.sim.reset()
+        else:
+            with self.worker.step_lock:
+                self.sim.reset()
+                self.worker.publish()
 
     def handle_event(self, event):
         if event.type == pygame.KEYDOWN:
             if event.key == pygame.K_SPACE:
-                self.sim.reset()
+                self.reset()
 
             if event.key == pygame.K_p:
                 self.time_handler.set_pause(toggle=True)
@@ -90,23 +193,28 @@ class GravitySimulationSystem(object):
             if event.key == pygame.K_PERIOD:
                 self.time_handler.increment_timewarp()
 
-        if event.type == Camera.CAMERAEVENT and event.movement == Camera.CAMERAMOVED:
-            self.sim.clear_planet_trails()
-
     def draw_background(self, surface, camera):
         log.info("Drawing Background")
         self.sim.draw_background(surface, camera)
 
     def draw_planets(self, surface, camera):
         log.info("Drawing planets")
-        self.sim.draw_planets(surface, camera)
+        if self.worker is None:
+            self.sim.draw_planets(surface, camera)
+            return
+
+        snapshot = self.worker.get_snapshot()
+        if snapshot is not self.drawn_snapshot:
+            self.sim.trails.sample(snapshot)
+            self.drawn_snapshot = snapshot
+        self.sim.draw_planets(surface, camera, snapshot)
 
     def draw_timewarp_image(self, surface):
         log.info("Drawing timewarp image")
         surface.blit(self.time_handler.get_timewarp_image(), (100, 800))
 
     def step(self):
-        if self.time_handler.paused is False:
+        if self.worker is None and self.time_handler.paused is False:
             self.sim.update_planets(self.time_handler.get_timestep())
 
     def draw(self, surface, camera):
@@ -0,0 +1,155 @@
+__author__ = 'charles.andrew.parker@gmail.com'
+
+import json
+import logging
+import math
+import threading
+import time
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+
+def get_bucket(value):
+    """
+    Power-of-two histogram bucket: the bucket b holds
+    values in [2**b, 2**(b+1)).  Zero goes in bucket None.
+    """
+    if value <= 0:
+        return None
+    return int(math.floor(math.log(value, 2)))
+
+
+class Histogram(object):
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = {}
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        bucket = get_bucket(value)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def summary(self):
+        return {"count": self.count,
+                "total": self.total,
+                "mean": self.total / self.count if self.count else 0.0,
+                "min": self.min,
+                "max": self.max,
+                "buckets": dict((str(b), n) for b, n in sorted(self.buckets.items()))}
+
+
+class Phase(object):
+    """
+    Context manager timing one pass through a phase.
+    """
+
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.instrumentation.record(self.name, time.time() - self.start)
+        return False
+
+
+class NullPhase(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+class Instrumentation(object):
+    """
+    Per-phase wall time and call counts, plus named counters, kept
+    as power-of-two histograms.  Phase times are histogrammed in
+    microseconds; counters are histogrammed per call to count().
+
+    summary() returns everything aggregated so far.  If a dump
+    interval is configured, tick() writes the summary as one JSON
+    line to the dump path (or the log) every that many seconds.
+
+    The simulation thread and the drawing thread both record, so the
+    histograms are only touched under a lock.
+    """
+
+    NULL_PHASE = NullPhase()
+
+    def __init__(self):
+        self.enabled = True
+        self.dump_interval = None
+        self.dump_path = None
+        self.lock = threading.Lock()
+        self.reset()
+
+    def configure(self, sim_config):
+        """
+        Applies the stats_* settings.  Entry points call this once:
+        several simulations can run at a time and share the counters.
+        """
+        self.enabled = sim_config.get("stats_enabled", True)
+        self.dump_interval = sim_config.get("stats_dump_interval", None)
+        self.dump_path = sim_config.get("stats_dump_path", None)
+
+    def reset(self):
+        with self.lock:
+            self.phases = {}
+            self.counters = {}
+            self.started = time.time()
+            self.last_dump = self.started
+
+    def phase(self, name):
+        if self.enabled is False:
+            return Instrumentation.NULL_PHASE
+        return Phase(self, name)
+
+    def record(self, name, seconds):
+        with self.lock:
+            if name not in self.phases:
+                self.phases[name] = Histogram()
+            self.phases[name].add(seconds * 1e6)
+
+    def count(self, name, value=1):
+        if self.enabled is False:
+            return
+        with self.lock:
+            if name not in self.counters:
+                self.counters[name] = Histogram()
+            self.counters[name].add(value)
+
+    def summary(self):
+        with self.lock:
+            return {"time": time.time(),
+                    "elapsed_seconds": time.time() - self.started,
+                    "phases_us": dict((name, h.summary()) for name, h in self.phases.items()),
+                    "counters": dict((name, h.summary()) for name, h in self.counters.items())}
+
+    def dump(self):
+        text = json.dumps(self.summary(), sort_keys=True)
+        if self.dump_path is None:
+            log.info("Stats: {}".format(text))
+        else:
+            with open(self.dump_path, "a") as f:
+                f.write(text + "\n")
+        self.last_dump = time.time()
+
+    def tick(self):
+        if self.dump_interval is not None and self.dump_interval <= time.time() - self.last_dump:
+            self.dump()
+
+
+# shared by the simulation, camera and drawing code
+stats = Instrumentation()
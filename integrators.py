@@ -0,0 +1,420 @@
+__author__ = 'charles.andrew.parker@gmail.com'
+
+import logging
+import numpy as np
+import solvers
+from instrumentation import stats
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+
+class EulerIntegrator(object):
+    """
+    First order: drift on the old velocity, then kick with
+    the acceleration at the start of the step.
+    """
+
+    name = "euler"
+    # attributes carried from one step to the next, saved in checkpoints
+    state_attributes = ()
+
+    def __init__(self, sim_config):
+        self.sim_config = sim_config
+
+    def step(self, sim, dt):
+        sim.update_acceleration()
+        sim.update_positions(dt)
+        sim.update_velocities(dt)
+
+
+class LeapfrogIntegrator(object):
+    """
+    Second order kick-drift-kick leapfrog (velocity Verlet).  The
+    acceleration at the end of a step is reused at the start of
+    the next, so it costs one force evaluation per step.
+    """
+
+    name = "leapfrog"
+    state_attributes = ()
+
+    def __init__(self, sim_config):
+        self.sim_config = sim_config
+
+    def substep(self, sim, dt):
+        if sim.accelerations_current is False:
+            sim.update_acceleration()
+        sim.update_velocities(0.5 * dt)
+        sim.update_positions(dt)
+        sim.update_acceleration()
+        sim.update_velocities(0.5 * dt)
+
+    def step(self, sim, dt):
+        self.substep(sim, dt)
+
+
+class YoshidaIntegrator(LeapfrogIntegrator):
+    """
+    Fourth order symplectic integrator built from three
+    leapfrog steps (Yoshida 1990).
+    """
+
+    name = "yoshida4"
+
+    CBRT_2 = 2.0 ** (1.0 / 3.0)
+    W1 = 1.0 / (2.0 - CBRT_2)
+    W0 = -CBRT_2 / (2.0 - CBRT_2)
+
+    def step(self, sim, dt):
+        for weight in (YoshidaIntegrator.W1, YoshidaIntegrator.W0, YoshidaIntegrator.W1):
+            self.substep(sim, weight * dt)
+
+
+class RK45Integrator(object):
+    """
+    Adaptive Dormand-Prince 5(4) Runge-Kutta.  Each call covers dt
+    with as many substeps as the embedded error estimate asks for;
+    the last accepted substep size is kept as the first guess for
+    the next call.
+    """
+
+    name = "rk45"
+    state_attributes = ("substep_size",)
+
+    A = [[],
+         [1.0 / 5],
+         [3.0 / 40, 9.0 / 40],
+         [44.0 / 45, -56.0 / 15, 32.0 / 9],
+         [19372.0 / 6561, -25360.0 / 2187, 64448.0 / 6561, -212.0 / 729],
+         [9017.0 / 3168, -355.0 / 33, 46732.0 / 5247, 49.0 / 176, -5103.0 / 18656],
+         [35.0 / 384, 0.0, 500.0 / 1113, 125.0 / 192, -2187.0 / 6784, 11.0 / 84]]
+    B5 = A[6] + [0.0]
+    B4 = [5179.0 / 57600, 0.0, 7571.0 / 16695, 393.0 / 640, -92097.0 / 339200, 187.0 / 2100, 1.0 / 40]
+
+    def __init__(self, sim_config):
+        self.sim_config = sim_config
+        self.tolerance = sim_config.get("rk45_tolerance", 1e-8)
+        self.min_fraction = sim_config.get("rk45_min_substep_fraction", 1e-6)
+        self.substep_size = None
+
+    def attempt(self, sim, pos0, vel0, h):
+        """
+        Takes one trial step of size h from (pos0, vel0) and returns
+        the fifth order result and its error estimate.
+        """
+        k_pos = []
+        k_vel = []
+        for row in RK45Integrator.A:
+            sim.store.pos = pos0 + h * sum(a * k for a, k in zip(row, k_pos))
+            vel = vel0 + h * sum(a * k for a, k in zip(row, k_vel))
+            sim.update_acceleration()
+            k_pos.append(vel)
+            k_vel.append(sim.store.acc.copy())
+
+        pos5 = pos0 + h * sum(b * k for b, k in zip(RK45Integrator.B5, k_pos))
+        vel5 = vel0 + h * sum(b * k for b, k in zip(RK45Integrator.B5, k_vel))
+        err_pos = h * sum((b5 - b4) * k for b5, b4, k in zip(RK45Integrator.B5, RK45Integrator.B4, k_pos))
+        err_vel = h * sum((b5 - b4) * k for b5, b4, k in zip(RK45Integrator.B5, RK45Integrator.B4, k_vel))
+
+        scale_pos = self.tolerance * (1.0 + np.maximum(np.abs(pos0), np.abs(pos5)))
+        scale_vel = self.tolerance * (1.0 + np.maximum(np.abs(vel0), np.abs(vel5)))
+        error = max(np.abs(err_pos / scale_pos).max(), np.abs(err_vel / scale_vel).max())
+        return pos5, vel5, error
+
+    def step(self, sim, dt):
+        if len(sim.store) == 0:
+            return
+
+        remaining = dt
+        h = dt if self.substep_size is None else min(self.substep_size, dt)
+        while 1e-12 * dt < remaining:
+            h = min(h, remaining)
+            pos0 = sim.store.pos.copy()
+            vel0 = sim.store.vel.copy()
+            pos, vel, error = self.attempt(sim, pos0, vel0, h)
+
+            if error <= 1.0 or h <= self.min_fraction * dt:
+                if 1.0 < error:
+                    log.warning("RK45 substep {} is at its minimum; accepting error {}".format(h, error))
+                sim.store.pos = pos
+                sim.store.vel = vel
+                remaining -= h
+                self.substep_size = h
+            else:
+                sim.store.pos = pos0
+                sim.store.vel = vel0
+
+            # standard step size controller for a fifth order method
+            factor = 5.0 if error == 0 else 0.9 * error ** -0.2
+            h *= min(5.0, max(0.2, factor))
+
+        # the last stage of an accepted step is evaluated at its end
+        # point, so the accelerations already match the new state
+
+
+class HermiteIntegrator(object):
+    """
+    Fourth order Hermite predictor-corrector with individual block
+    timesteps (Makino & Aarseth 1992).
+
+    Each body advances with dt / 2**k, with k picked per body from its
+    acceleration and its derivatives, and at each block time forces are
+    only recomputed for the bodies that are due.  Forces are always
+    evaluated directly here, because the jerk is needed as well.
+    """
+
+    name = "hermite"
+    state_attributes = ("jerk", "desired_dt", "force_evaluations")
+
+    # the smallest block is dt / 2**MAX_LEVEL
+    MAX_LEVEL = 20
+
+    def __init__(self, sim_config):
+        self.sim_config = sim_config
+        self.accuracy = sim_config.get("hermite_accuracy", 0.02)
+        self.start_accuracy = sim_config.get("hermite_start_accuracy", 0.01)
+        self.jerk = None
+        self.desired_dt = None
+        self.force_evaluations = 0
+
+    def evaluate(self, sim, active, pos, vel):
+        acc = np.zeros((len(active), 3))
+        jerk = np.zeros((len(active), 3))
+        with stats.phase("force"):
+            solvers.direct.accumulate_accelerations_and_jerks(active, pos, vel, sim.store.mass, sim.BIG_G, acc, jerk)
+        stats.count("pairs_evaluated", len(active) * (len(sim.store) - 1))
+        self.force_evaluations += len(active)
+        return acc, jerk
+
+    def initialize(self, sim):
+        log.debug("Starting Hermite integration for {} bodies".format(len(sim.store)))
+        everyone = np.arange(len(sim.store))
+        acc, self.jerk = self.evaluate(sim, everyone, sim.store.pos, sim.store.vel)
+        sim.store.acc = acc
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.desired_dt = self.start_accuracy * norm(acc) / norm(self.jerk)
+        self.desired_dt[~np.isfinite(self.desired_dt)] = np.inf
+
+    def get_levels(self, dt, desired_dt):
+        with np.errstate(divide='ignore'):
+            levels = np.ceil(np.log2(dt / desired_dt))
+        return np.clip(levels, 0, HermiteIntegrator.MAX_LEVEL).astype(int)
+
+    def get_timesteps(self, acc, jerk, snap, crackle):
+        """
+        Aarseth's timestep criterion.
+        """
+        a, j, s, c = norm(acc), norm(jerk), norm(snap), norm(crackle)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            timesteps = np.sqrt(self.accuracy * (a * s + j ** 2) / (j * c + s ** 2))
+        timesteps[~np.isfinite(timesteps)] = np.inf
+        return timesteps
+
+    def step(self, sim, dt):
+        store = sim.store
+        n = len(store)
+        if n == 0:
+            return
+
+        if sim.accelerations_current is False or self.jerk is None or len(self.jerk) != n:
+            self.initialize(sim)
+
+        end = 1 << HermiteIntegrator.MAX_LEVEL
+        tick = float(dt) / end
+        level = self.get_levels(dt, self.desired_dt)
+        time = np.zeros(n, dtype=np.int64)
+
+        while time.min() < end:
+            due = time + np.right_shift(end, level)
+            now = due.min()
+            active = np.nonzero(due == now)[0]
+
+            # predict every body to the block time
+            h = ((now - time) * tick)[:, np.newaxis]
+            pos = store.pos + h * (store.vel + h * (store.acc / 2 + h * self.jerk / 6))
+            vel = store.vel + h * (store.acc + h * self.jerk / 2)
+            a1, j1 = self.evaluate(sim, active, pos, vel)
+
+            # correct the bodies that are due
+            h = h[active]
+            a0, j0 = store.acc[active], self.jerk[active]
+            x0, v0 = store.pos[active], store.vel[active]
+            v1 = v0 + h * (a0 + a1) / 2 + h ** 2 * (j0 - j1) / 12
+            x1 = x0 + h * (v0 + v1) / 2 + h ** 2 * (a0 - a1) / 12
+            store.pos[active] = x1
+            store.vel[active] = v1
+            store.acc[active] = a1
+            self.jerk[active] = j1
+            time[active] = now
+
+            snap = (-6 * (a0 - a1) - h * (4 * j0 + 2 * j1)) / h ** 2
+            crackle = (12 * (a0 - a1) + 6 * h * (j0 + j1)) / h ** 3
+            self.desired_dt[active] = self.get_timesteps(a1, j1, snap + h * crackle, crackle)
+
+            # grow by at most one level, and only onto a block boundary
+            new_level = np.maximum(self.get_levels(dt, self.desired_dt[active]), level[active] - 1)
+            misaligned = now % np.right_shift(end, new_level) != 0
+            while misaligned.any():
+                new_level[misaligned] += 1
+                misaligned = now % np.right_shift(end, new_level) != 0
+            level[active] = new_level
+
+        sim.accelerations_current = True
+
+
+def get_stumpff(z):
+    """
+    The Stumpff functions C(z) and S(z), with series
+    near z = 0 where the closed forms lose precision.
+    """
+    c = np.empty_like(z)
+    s = np.empty_like(z)
+    small = np.abs(z) < 1e-3
+    pos = (z > 0) & ~small
+    neg = (z < 0) & ~small
+
+    zs = z[small]
+    c[small] = 1.0 / 2 - zs / 24 + zs ** 2 / 720
+    s[small] = 1.0 / 6 - zs / 120 + zs ** 2 / 5040
+    root = np.sqrt(z[pos])
+    c[pos] = (1 - np.cos(root)) / z[pos]
+    s[pos] = (root - np.sin(root)) / root ** 3
+    root = np.sqrt(-z[neg])
+    c[neg] = (np.cosh(root) - 1) / -z[neg]
+    s[neg] = (np.sinh(root) - root) / root ** 3
+    return c, s
+
+
+def kepler_drift(pos, vel, mu, dt, tolerance=1e-13, max_iterations=50):
+    """
+    Advances every (pos, vel) row by dt along its two-body orbit around
+    a fixed centre of gravitational parameter mu, bound or not, using
+    universal variables and Lagrange's f and g functions.  The
+    universal anomaly is found with Laguerre-Conway iteration.
+    """
+    sqrt_mu = np.sqrt(mu)
+    r0 = norm(pos)
+    sigma = np.einsum('ij,ij->i', pos, vel) / sqrt_mu
+    alpha = 2.0 / r0 - np.einsum('ij,ij->i', vel, vel) / mu
+    beta = 1 - alpha * r0
+
+    chi = sqrt_mu * dt * np.where(0 < alpha, alpha, 1.0 / r0)
+    for _ in range(max_iterations):
+        z = alpha * chi ** 2
+        c, s = get_stumpff(z)
+        f = sigma * chi ** 2 * c + beta * chi ** 3 * s + r0 * chi - sqrt_mu * dt
+        df = sigma * chi * (1 - z * s) + beta * chi ** 2 * c + r0
+        ddf = sigma * (1 - z * c) + beta * chi * (1 - z * s)
+        root = np.sqrt(np.abs(16 * df ** 2 - 20 * f * ddf))
+        delta = 5 * f / (df + np.where(0 <= df, root, -root))
+        chi = chi - delta
+        if (np.abs(delta) <= tolerance * np.maximum(np.abs(chi), 1.0)).all():
+            break
+    else:
+        log.warning("Kepler drift did not converge for {} bodies".format(
+            int((tolerance * np.maximum(np.abs(chi), 1.0) < np.abs(delta)).sum())))
+
+    z = alpha * chi ** 2
+    c, s = get_stumpff(z)
+    f = 1 - chi ** 2 / r0 * c
+    g = dt - chi ** 3 / sqrt_mu * s
+    new_pos = f[:, np.newaxis] * pos + g[:, np.newaxis] * vel
+    r = norm(new_pos)
+    df = sqrt_mu / (r * r0) * (z * chi * s - chi)
+    dg = 1 - chi ** 2 / r * c
+    new_vel = df[:, np.newaxis] * pos + dg[:, np.newaxis] * vel
+    return new_pos, new_vel
+
+
+def norm(vectors):
+    return np.sqrt(np.einsum('ij,ij->i', vectors, vectors))
+
+
+class WisdomHolmanIntegrator(object):
+    """
+    Second order mixed-variable symplectic integrator (Wisdom & Holman
+    1991) in democratic heliocentric coordinates (Duncan, Levison &
+    Lee 1998), for systems dominated by one central star.
+
+    The most massive body is the star.  Every other body drifts
+    analytically along its Kepler orbit around it, and only the
+    forces between the other bodies are applied as kicks, so the
+    step can be as large as those much weaker forces allow.  The
+    kicks use the configured force solver.
+    """
+
+    name = "wisdom_holman"
+    state_attributes = ("host",)
+
+    def __init__(self, sim_config):
+        self.sim_config = sim_config
+        self.host = None
+
+    def update_interaction_accelerations(self, sim, host):
+        """
+        Accelerations from every body except the star.
+        """
+        mass = sim.store.mass
+        host_mass = mass[host]
+        mass[host] = 0.0
+        try:
+            sim.update_acceleration()
+        finally:
+            mass[host] = host_mass
+
+    def step(self, sim, dt):
+        store = sim.store
+        if len(store) < 2:
+            EulerIntegrator(self.sim_config).step(sim, dt)
+            return
+
+        mass = store.mass
+        host = int(np.argmax(mass))
+        others = np.arange(len(store)) != host
+        total_mass = mass.sum()
+        center = mass.dot(store.pos) / total_mass
+        center_vel = mass.dot(store.vel) / total_mass
+
+        if sim.accelerations_current is False or self.host != host:
+            self.update_interaction_accelerations(sim, host)
+        self.host = host
+
+        # heliocentric positions and barycentric velocities
+        helio_pos = store.pos[others] - store.pos[host]
+        bary_vel = store.vel[others] - center_vel
+        m = mass[others][:, np.newaxis]
+
+        bary_vel += 0.5 * dt * store.acc[others]
+        helio_pos += 0.5 * dt * (m * bary_vel).sum(axis=0) / mass[host]
+        helio_pos, bary_vel = kepler_drift(helio_pos, bary_vel, sim.BIG_G * mass[host], dt)
+        helio_pos += 0.5 * dt * (m * bary_vel).sum(axis=0) / mass[host]
+
+        center = center + dt * center_vel
+        store.pos[host] = center - (m * helio_pos).sum(axis=0) / total_mass
+        store.pos[others] = store.pos[host] + helio_pos
+
+        self.update_interaction_accelerations(sim, host)
+        bary_vel += 0.5 * dt * store.acc[others]
+        store.vel[others] = bary_vel + center_vel
+        store.vel[host] = center_vel - (m * bary_vel).sum(axis=0) / mass[host]
+
+
+INTEGRATORS = {
+    EulerIntegrator.name: EulerIntegrator,
+    LeapfrogIntegrator.name: LeapfrogIntegrator,
+    YoshidaIntegrator.name: YoshidaIntegrator,
+    RK45Integrator.name: RK45Integrator,
+    HermiteIntegrator.name: HermiteIntegrator,
+    WisdomHolmanIntegrator.name: WisdomHolmanIntegrator,
+}
+
+
+def get_integrator(sim_config):
+    """
+    Builds the integrator named by sim_config["integrator"],
+    defaulting to the original first order scheme.
+    """
+    name = sim_config.get("integrator", EulerIntegrator.name)
+    if name not in INTEGRATORS:
+        raise ValueError("Unknown integrator {}; expected one of {}".format(name, sorted(INTEGRATORS)))
+    return INTEGRATORS[name](sim_config)
@@ -4,6 +4,7 @@ import pygame
 import numpy as np
 import logging
 from coordinate import Coordinate
+from tracing import tracer
 import itertools
 
 log = logging.getLogger(__name__)
@@ -11,6 +12,11 @@ log.setLevel(logging.DEBUG)
 
 
 class Trail(object):
+    """
+    Screen-space trail of a single planet.  Planets no longer keep
+    one, but recordings made while they did still refer to it.
+    """
+
     def __init__(self, max_len_of_trail, snapshot_interval):
         self.counter = itertools.count()
         self.interval = snapshot_interval
@@ -52,20 +58,77 @@ class Planet(object):
     def get_collision_distance(cls, a, b):
         return a.get_radius() + b.get_radius()
 
+    @classmethod
+    def get_radius_for_mass(cls, mass):
+        return 2.0 * mass ** (1.0/3.0)
+
     def __init__(self, **kwargs):
         self.args = kwargs
         self.name = kwargs["name"]
         self.coord = Coordinate(kwargs["pos"], kwargs["vel"])
-        self.mass = kwargs["mass"]
+        self._mass = kwargs["mass"]
+        self._radius = 0
         self.color = kwargs["color"]
         self.border = 0
         self.kinetic_energy = self.get_kinetic_energy()
         self.potential_energy = 0
-        self.radius = 0
         self.get_radius(update=True)
         self.sphere_of_influence = 0
         self.get_sphere_of_influence(update=True)
-        self.trail = Trail(40, 1)
+
+    def bind(self, store, index):
+        """
+        Makes this planet's mass, radius and coordinate
+        views into row `index` of a BodyStore.
+        """
+        self.coord.bind(store, index)
+
+    def unbind(self):
+        if self.coord.store is not None:
+            self._mass = self.mass
+            self._radius = self.radius
+            self.coord.unbind()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_mass"] = self.mass
+        state["_radius"] = self.radius
+        return state
+
+    def __setstate__(self, state):
+        # Recordings made before the body store existed pickled
+        # mass and radius as plain attributes
+        if "mass" in state:
+            state["_mass"] = state.pop("mass")
+        if "radius" in state:
+            state["_radius"] = state.pop("radius")
+        self.__dict__.update(state)
+
+    @property
+    def mass(self):
+        if self.coord.store is None:
+            return self._mass
+        return self.coord.store.mass[self.coord.index]
+
+    @mass.setter
+    def mass(self, value):
+        if self.coord.store is None:
+            self._mass = value
+        else:
+            self.coord.store.mass[self.coord.index] = value
+
+    @property
+    def radius(self):
+        if self.coord.store is None:
+            return self._radius
+        return self.coord.store.radius[self.coord.index]
+
+    @radius.setter
+    def radius(self, value):
+        if self.coord.store is None:
+            self._radius = value
+        else:
+            self.coord.store.radius[self.coord.index] = value
 
     def get_distance_to_other_body(self, other):
         dist, vect = Coordinate.get_distance_and_radius_vector(self.coord, other.coord)
@@ -87,7 +150,7 @@ class Planet(object):
 
     def get_radius(self, update=False):
         if update is True:
-            self.radius = 2.0 * self.mass ** (1.0/3.0)
+            self.radius = Planet.get_radius_for_mass(self.mass)
         return self.radius
 
     def collide(self, planet):
@@ -102,38 +165,33 @@ class Planet(object):
         else:
             return True
 
-    def clear_planet_trail(self):
-        self.trail.clear_trail()
-
     def draw(self, surface, camera):
         r, pos = camera.get_apparent_radius_and_draw_pos(self.coord, self.get_radius())
+        return self.draw_projected(surface, r, pos)
+
+    def draw_projected(self, surface, r, pos):
+        """
+        Draws the planet at an already projected
+        screen position and apparent radius.
+        """
         if self.check_if_visible(r) is False:
-            log.debug("Planet {} is too small to draw at this scale.".format(self.name))
+            tracer.record("body", "too_small", self.name, r)
             return False
 
         elif pos is not None:
-            self.trail.add_position_and_radius_to_trail(pos, r)
-            log.debug("Drawing circle: coord={}; radius={}; border={}".format(self.coord.pos,
-                                                                              self.get_radius(),
-                                                                              self.border))
+            tracer.record("body", "draw", self.name, pos, r, self.border)
             pygame.draw.circle(surface,
                                self.color,
                                pos,
                                np.round(r).astype(int),
                                self.border)
-            trail = self.trail.get_position_and_radius_trail()
-            if trail is not None:
-                plist, _ = zip(*self.trail.get_position_and_radius_trail())
-                pygame.draw.lines(surface,
-                                  self.color,
-                                  False,
-                                  plist,
-                                  1)
-
             return True
 
     def draw_sphere_of_influence(self, surface, camera):
         r, pos = camera.get_apparent_radius_and_draw_pos(self.coord, self.get_sphere_of_influence())
+        self.draw_sphere_of_influence_projected(surface, r, pos)
+
+    def draw_sphere_of_influence_projected(self, surface, r, pos):
         if self.check_if_visible(r) is True and pos is not None:
             pygame.draw.circle(surface,
                                self.color,
@@ -151,8 +209,11 @@ class BackgroundStar(object):
 
     def draw(self, surface, camera):
         _, pos = camera.get_apparent_radius_and_draw_pos(self.coord, self.radius)
+        self.draw_projected(surface, pos)
+
+    def draw_projected(self, surface, pos):
         if pos is not None:
-            log.debug("Drawing background star: coord={}; radius={};".format(self.coord.pos, self.radius))
+            tracer.record("body", "draw_background_star", pos, self.radius)
             pygame.draw.circle(surface,
                                self.color,
                                pos,
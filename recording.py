@@ -0,0 +1,650 @@
+__author__ = 'charles.andrew.parker@gmail.com'
+
+import Queue
+import bisect
+import json
+import logging
+import os
+import struct
+import zipfile
+import threading
+from collections import OrderedDict
+import numpy as np
+from objects import body
+from instrumentation import stats
+import framecodec
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+MAGIC = "GRAVREC1"
+VERSION = 1
+ALIGNMENT = 64
+
+
+def get_frame_dtype(num_bodies):
+    """
+    One frame of a recording: the step count and simulation time,
+    then per body its position, velocity, mass, radius and whether
+    it is still alive.  Bodies absorbed in collisions are zeroed.
+    """
+    return np.dtype([("step", "<i8"),
+                     ("sim_time", "<f8"),
+                     ("pos", "<f8", (num_bodies, 3)),
+                     ("vel", "<f8", (num_bodies, 3)),
+                     ("mass", "<f8", (num_bodies,)),
+                     ("radius", "<f8", (num_bodies,)),
+                     ("alive", "u1", (num_bodies,))])
+
+
+def describe_dtype(dtype):
+    return [[name, dtype.fields[name][0].base.str, list(dtype.fields[name][0].shape)] for name in dtype.names]
+
+
+def get_body_table(bodies):
+    return [{"id": i,
+             "name": b.name,
+             "color": [int(c) for c in b.color],
+             "mass": float(b.mass)} for i, b in enumerate(bodies)]
+
+
+def write_header(f, header):
+    """
+    Writes the magic string, the length of the JSON header and the
+    header itself, padded so the frames start on an aligned offset.
+    Returns that offset.
+    """
+    text = json.dumps(header, sort_keys=True)
+    start = len(MAGIC) + 8
+    data_offset = -(-(start + len(text)) // ALIGNMENT) * ALIGNMENT
+    text += " " * (data_offset - start - len(text))
+    f.write(MAGIC)
+    f.write(struct.pack("<Q", len(text)))
+    f.write(text)
+    return data_offset
+
+
+def read_header(f):
+    magic = f.read(len(MAGIC))
+    if magic != MAGIC:
+        raise ValueError("Not a gravipy recording (magic {!r})".format(magic))
+    length, = struct.unpack("<Q", f.read(8))
+    return json.loads(f.read(length)), len(MAGIC) + 8 + length
+
+
+class RecordingWriter(object):
+    """
+    Writes a columnar recording: a JSON header with every body's id,
+    name, color and starting mass, followed by fixed-size frames of
+    get_frame_dtype(num_bodies).  Body i of the header is column i of
+    every frame; the set of bodies is fixed when the writer is made.
+
+    Frames are gathered into a chunk of chunk_frames and appended to
+    the file a chunk at a time, so memory stays the same however long
+    the run.  Every fsync_chunks chunks the file is synced to disk;
+    after a crash it reads back at least up to the last synced chunk.
+    """
+
+    def __init__(self, path, bodies, metadata=None, chunk_frames=64, fsync_chunks=16, interval=1):
+        self.path = path
+        self.interval = interval
+        self.bodies = list(bodies)
+        self.columns = dict((id(b), i) for i, b in enumerate(self.bodies))
+        self.dtype = get_frame_dtype(len(self.bodies))
+        self.chunk = np.zeros(max(1, chunk_frames), dtype=self.dtype)
+        self.buffered = 0
+        self.fsync_chunks = fsync_chunks
+        self.chunks_written = 0
+        self.indexed_bodies = None
+        self.indices = None
+        self.frames_written = 0
+
+        self.file = open(path, "wb")
+        self.data_offset = write_header(self.file, self.get_header(metadata))
+        self.sync()
+
+    def get_header(self, metadata):
+        return {"version": VERSION,
+                "codec": "raw",
+                "num_bodies": len(self.bodies),
+                "bodies": get_body_table(self.bodies),
+                "frame_fields": describe_dtype(self.dtype),
+                "frame_size": self.dtype.itemsize,
+                "chunk_frames": len(self.chunk),
+                "interval": self.interval,
+                "metadata": metadata or {}}
+
+    def encode_chunk(self, frames):
+        return frames.tobytes()
+
+    def get_columns(self, bodies):
+        """
+        The recording column of every body, cached until the list
+        of bodies changes.
+        """
+        if self.indexed_bodies is not bodies or len(self.indices) != len(bodies):
+            try:
+                self.indices = np.array([self.columns[id(b)] for b in bodies], dtype=int)
+            except KeyError:
+                raise ValueError("The simulation has bodies that are not in the recording {}".format(self.path))
+            self.indexed_bodies = bodies
+        return self.indices
+
+    def fill_frame(self, frame, store, step, sim_time):
+        columns = self.get_columns(store.bodies)
+        frame["step"] = step
+        frame["sim_time"] = sim_time
+        for name in ("pos", "vel", "mass", "radius", "alive"):
+            frame[name] = 0
+        frame["pos"][columns] = store.pos
+        frame["vel"][columns] = store.vel
+        frame["mass"][columns] = store.mass
+        frame["radius"][columns] = store.radius
+        frame["alive"][columns] = 1
+
+    def write_frame(self, store, step=0, sim_time=0.0):
+        self.fill_frame(self.chunk[self.buffered], store, step, sim_time)
+        self.buffered += 1
+        self.frames_written += 1
+        if self.buffered == len(self.chunk):
+            self.write_chunk()
+
+    def write_chunk(self):
+        if self.buffered == 0:
+            return
+        self.write_encoded(self.encode_chunk(self.chunk[:self.buffered]))
+        self.buffered = 0
+
+    def write_encoded(self, data):
+        """
+        Appends a chunk that has already been encoded.
+        """
+        self.file.write(data)
+        self.chunks_written += 1
+        if 0 < self.fsync_chunks and self.chunks_written % self.fsync_chunks == 0:
+            self.sync()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        if not self.file.closed:
+            self.write_chunk()
+            self.sync()
+            self.file.close()
+
+
+class DeltaRecordingWriter(RecordingWriter):
+    """
+    Writes a recording compressed with framecodec: every chunk starts
+    with a keyframe, then stores each frame as quantized residuals
+    against the frame before.  Positions are kept to within half of
+    position_precision and velocities to within half of
+    velocity_precision; masses and radii are exact.
+    """
+
+    def __init__(self, path, bodies, metadata=None, chunk_frames=64, fsync_chunks=16, interval=1,
+                 position_precision=1e-3, velocity_precision=1e-6, level=6):
+        self.position_precision = position_precision
+        self.velocity_precision = velocity_precision
+        self.level = level
+        RecordingWriter.__init__(self, path, bodies, metadata, chunk_frames, fsync_chunks, interval)
+
+    def get_header(self, metadata):
+        header = RecordingWriter.get_header(self, metadata)
+        header["codec"] = "delta"
+        header["position_precision"] = self.position_precision
+        header["velocity_precision"] = self.velocity_precision
+        return header
+
+    def encode_chunk(self, frames):
+        return framecodec.encode_chunk(frames, self.position_precision, self.velocity_precision, self.level)
+
+
+WRITERS = {"raw": RecordingWriter,
+           "delta": DeltaRecordingWriter}
+
+
+def get_writer(path, bodies, metadata, sim_config):
+    """
+    A writer for the codec named by sim_config["recording_codec"].
+    """
+    codec = sim_config.get("recording_codec", "raw")
+    if codec not in WRITERS:
+        raise ValueError("Unknown recording codec {!r}, expected one of {}".format(codec, sorted(WRITERS)))
+    kwargs = {"chunk_frames": sim_config.get("recording_chunk_frames", 64),
+              "fsync_chunks": sim_config.get("recording_fsync_chunks", 16),
+              "interval": sim_config.get("recording_interval", 1)}
+    if codec == "delta":
+        kwargs["position_precision"] = sim_config.get("recording_position_precision", 1e-3)
+        kwargs["velocity_precision"] = sim_config.get("recording_velocity_precision", 1e-6)
+    return WRITERS[codec](path, bodies, metadata, **kwargs)
+
+
+class Recorder(object):
+    """
+    Streams a running simulation to a recording, one frame every
+    recording_interval steps, with the writer chosen by get_writer.
+    Players fill in the steps in between by interpolation.
+    """
+
+    def __init__(self, path, sim, metadata=None):
+        self.interval = sim.sim_config.get("recording_interval", 1)
+        self.writer = get_writer(path, sim.planets, metadata, sim.sim_config)
+        self.record(sim)
+
+    def record(self, sim):
+        if sim.steps % self.interval == 0:
+            self.writer.write_frame(sim.store, sim.steps, sim.sim_time)
+
+    def close(self):
+        self.writer.close()
+
+
+class RecordingPipeline(object):
+    """
+    Streams a running simulation to a recording without encoding or
+    writing on the simulation's thread.  record() only copies the
+    frame into a bounded queue; an assembler thread gathers frames
+    into chunks, recording_encoder_threads threads encode the chunks
+    in parallel, and they are written in order as they finish.
+
+    When the queue of recording_queue_frames is full,
+    recording_backpressure decides what record() does:
+
+      - "block" waits for room, so no frame is lost;
+      - "drop" throws the frame away;
+      - "downsample" throws it away and records every other frame
+        from then on, halving again each time the queue fills, until
+        the queue has drained to a quarter.
+
+    Players follow the step recorded with each frame, so a stretch
+    with dropped frames plays at the same speed as the rest, with the
+    longer gaps interpolated over.
+
+    If encoding or writing fails the pipeline stops: later frames are
+    thrown away and the error is raised once, by the next record() or
+    by close().
+    """
+
+    POLICIES = ("block", "drop", "downsample")
+    MAX_STRIDE = 64
+
+    def __init__(self, path, sim, metadata=None):
+        sim_config = sim.sim_config
+        self.policy = sim_config.get("recording_backpressure", "block")
+        if self.policy not in RecordingPipeline.POLICIES:
+            raise ValueError("Unknown recording backpressure policy {!r}, expected one of {}".format(
+                self.policy, RecordingPipeline.POLICIES))
+        self.interval = sim_config.get("recording_interval", 1)
+        self.writer = get_writer(path, sim.planets, metadata, sim_config)
+        self.chunk_frames = len(self.writer.chunk)
+        self.queue_frames = sim_config.get("recording_queue_frames", 4 * self.chunk_frames)
+        self.frames = Queue.Queue(self.queue_frames)
+        num_encoders = max(1, sim_config.get("recording_encoder_threads", 2))
+        self.chunks = Queue.Queue(2 * num_encoders)
+        self.stride = 1
+        self.frames_queued = 0
+        self.frames_dropped = 0
+        self.error = None
+        self.error_raised = False
+
+        # encoded chunks wait here until every chunk before them is written
+        self.write_lock = threading.Lock()
+        self.encoded = {}
+        self.next_chunk = 0
+
+        self.assembler = threading.Thread(target=self.run_assembler, name="recording-assembler")
+        self.encoders = [threading.Thread(target=self.run_encoder, name="recording-encoder-{}".format(n))
+                         for n in range(num_encoders)]
+        for thread in [self.assembler] + self.encoders:
+            thread.daemon = True
+            thread.start()
+        self.record(sim)
+
+    def record(self, sim):
+        if self.error is not None:
+            self.raise_error()
+            return
+        if sim.steps % (self.interval * self.stride) != 0:
+            return
+
+        frame = np.empty((), dtype=self.writer.dtype)
+        self.writer.fill_frame(frame, sim.store, sim.steps, sim.sim_time)
+        if self.policy == "block":
+            self.frames.put(frame)
+            self.frames_queued += 1
+            return
+
+        try:
+            self.frames.put_nowait(frame)
+            self.frames_queued += 1
+        except Queue.Full:
+            self.frames_dropped += 1
+            stats.count("recording_frames_dropped")
+            if self.policy == "downsample":
+                self.stride = min(2 * self.stride, RecordingPipeline.MAX_STRIDE)
+                log.warning("Recording queue full, recording every {}th frame".format(self.stride))
+            return
+        if 1 < self.stride and self.frames.qsize() <= self.queue_frames // 4:
+            self.stride //= 2
+
+    def run_assembler(self):
+        index = 0
+        chunk = np.empty(self.chunk_frames, dtype=self.writer.dtype)
+        buffered = 0
+        while True:
+            frame = self.frames.get()
+            if frame is None:
+                break
+            chunk[buffered] = frame
+            buffered += 1
+            if buffered == self.chunk_frames:
+                self.chunks.put((index, chunk))
+                index += 1
+                chunk = np.empty(self.chunk_frames, dtype=self.writer.dtype)
+                buffered = 0
+        if 0 < buffered:
+            self.chunks.put((index, chunk[:buffered]))
+        for _ in self.encoders:
+            self.chunks.put(None)
+
+    def run_encoder(self):
+        while True:
+            job = self.chunks.get()
+            if job is None:
+                return
+            index, chunk = job
+            if self.error is not None:
+                # keep draining so record() and close() never wait on us
+                continue
+            try:
+                data = self.writer.encode_chunk(chunk)
+                with self.write_lock:
+                    if self.error is None:
+                        self.encoded[index] = data
+                        while self.next_chunk in self.encoded:
+                            self.writer.write_encoded(self.encoded.pop(self.next_chunk))
+                            self.next_chunk += 1
+            except Exception as e:
+                log.exception("Recording to {} failed".format(self.writer.path))
+                with self.write_lock:
+                    if self.error is None:
+                        self.error = e
+                    self.encoded.clear()
+
+    def raise_error(self):
+        """
+        Raises the error that stopped the pipeline, the first time
+        it is asked.
+        """
+        if self.error is not None and not self.error_raised:
+            self.error_raised = True
+            raise self.error
+
+    def close(self):
+        """
+        Waits for every queued frame to be written.
+        """
+        self.frames.put(None)
+        self.assembler.join()
+        for thread in self.encoders:
+            thread.join()
+        try:
+            self.writer.close()
+        finally:
+            self.raise_error()
+
+
+def get_recorder(path, sim, metadata=None):
+    """
+    A RecordingPipeline when sim_config["recording_encoder_threads"]
+    asks for encoder threads, otherwise a Recorder that encodes on
+    the simulation's thread.
+    """
+    if 0 < sim.sim_config.get("recording_encoder_threads", 0):
+        return RecordingPipeline(path, sim, metadata)
+    return Recorder(path, sim, metadata)
+
+
+def set_body_table(rec, header):
+    rec.num_bodies = header["num_bodies"]
+    rec.dtype = get_frame_dtype(rec.num_bodies)
+    if rec.dtype.itemsize != header["frame_size"]:
+        raise ValueError("Unsupported frame layout in {}".format(rec.path))
+    rec.names = [b["name"] for b in header["bodies"]]
+    rec.colors = [tuple(b["color"]) for b in header["bodies"]]
+    rec.masses = np.array([b["mass"] for b in header["bodies"]])
+    rec.interval = header.get("interval", 1)
+
+
+def get_planets(rec, frame):
+    """
+    The bodies alive in a frame of rec, as Planets.
+    """
+    planets = []
+    for i in np.nonzero(frame["alive"])[0]:
+        planet = body.Planet(name=rec.names[i],
+                             pos=np.array(frame["pos"][i]),
+                             vel=np.array(frame["vel"][i]),
+                             mass=float(frame["mass"][i]),
+                             color=rec.colors[i])
+        # the same body in every frame, for anything that follows it
+        planet.recording_id = int(i)
+        planets.append(planet)
+    return planets
+
+
+def interpolate_frames(a, b, u):
+    """
+    The state a fraction u of the way from frame a to frame b, by
+    cubic Hermite interpolation of each body's position and velocity
+    over the time between the frames.  Bodies that merged in between
+    jump rather than move smoothly, so they and the masses and radii
+    of all bodies are taken from the nearer frame.
+    """
+    frame = np.zeros(1, dtype=a.dtype)[0]
+    dt = b["sim_time"] - a["sim_time"]
+    frame["step"] = a["step"] + int(round(u * (b["step"] - a["step"])))
+    frame["sim_time"] = a["sim_time"] + u * dt
+
+    h00, h10, h01, h11 = 2 * u**3 - 3 * u**2 + 1, u**3 - 2 * u**2 + u, -2 * u**3 + 3 * u**2, u**3 - u**2
+    d00, d10, d01, d11 = 6 * u**2 - 6 * u, 3 * u**2 - 4 * u + 1, -6 * u**2 + 6 * u, 3 * u**2 - 2 * u
+    p0, v0, p1, v1 = a["pos"], a["vel"], b["pos"], b["vel"]
+    pos = h00 * p0 + h10 * dt * v0 + h01 * p1 + h11 * dt * v1
+    vel = (d00 * p0 + d01 * p1) / dt + d10 * v0 + d11 * v1 if dt != 0 else v0 + u * (v1 - v0)
+
+    nearer = a if u < 0.5 else b
+    both = (a["alive"] == 1) & (b["alive"] == 1) & (a["mass"] == b["mass"])
+    frame["alive"] = nearer["alive"]
+    frame["mass"] = nearer["mass"]
+    frame["radius"] = nearer["radius"]
+    frame["pos"] = np.where(both[:, np.newaxis], pos, nearer["pos"])
+    frame["vel"] = np.where(both[:, np.newaxis], vel, nearer["vel"])
+    return frame
+
+
+class Recording(object):
+    """
+    A columnar recording opened read-only.  `frames` is a memory map
+    of every complete frame, so frames["pos"] is a (frames, bodies, 3)
+    array read from disk only as it is touched, whatever the length
+    of the recording.  A frame cut short by a crash is ignored, as are
+    trailing frames that never reached the disk and read as zeros.
+
+    A recording stored inside another file, such as an uncompressed
+    zip member, is opened with its offset and size in that file.
+    """
+
+    def __init__(self, path, offset=0, size=None):
+        self.path = path
+        if size is None:
+            size = os.path.getsize(path) - offset
+        with open(path, "rb") as f:
+            f.seek(offset)
+            self.header, header_size = read_header(f)
+        self.data_offset = offset + header_size
+        set_body_table(self, self.header)
+
+        num_frames = (size - header_size) // self.dtype.itemsize
+        self.frames = np.zeros(0, dtype=self.dtype)
+        if 0 < num_frames:
+            self.frames = np.memmap(path, dtype=self.dtype, mode="r", offset=self.data_offset, shape=(num_frames,))
+            # every written frame has a body alive in it
+            while 0 < num_frames and not self.frames[num_frames - 1]["alive"].any():
+                num_frames -= 1
+            self.frames = self.frames[:num_frames]
+
+    def __len__(self):
+        return len(self.frames)
+
+    def get_frame(self, index):
+        return self.frames[index]
+
+    def get_steps(self):
+        """
+        The simulation step of every frame.
+        """
+        return np.array(self.frames["step"])
+
+    def get_planets(self, index):
+        return get_planets(self, self.get_frame(index))
+
+    def close(self):
+        if isinstance(self.frames, np.memmap):
+            self.frames._mmap.close()
+        self.frames = np.zeros(0, dtype=self.dtype)
+
+
+class DeltaRecording(object):
+    """
+    A recording written by DeltaRecordingWriter.  Opening it reads
+    only the small header in front of each chunk; a chunk is decoded
+    when one of its frames is asked for, and the last few decoded
+    chunks are kept.  A chunk cut short by a crash is ignored.
+    """
+
+    CACHED_CHUNKS = 4
+
+    def __init__(self, path, offset=0, size=None):
+        self.path = path
+        if size is None:
+            size = os.path.getsize(path) - offset
+        self.chunk_offsets = []
+        self.chunk_sizes = []
+        self.first_frames = [0]
+        self.step_runs = []
+        with open(path, "rb") as f:
+            f.seek(offset)
+            self.header, header_size = read_header(f)
+            position = offset + header_size
+            end = offset + size
+            while position + framecodec.CHUNK_HEADER.size <= end:
+                f.seek(position)
+                try:
+                    text_length, payload_length = framecodec.read_chunk_header(f.read(framecodec.CHUNK_HEADER.size))
+                except ValueError:
+                    break
+                chunk_size = framecodec.CHUNK_HEADER.size + text_length + payload_length
+                if end < position + chunk_size:
+                    break
+                layout = json.loads(f.read(text_length))
+                self.chunk_offsets.append(position)
+                self.chunk_sizes.append(chunk_size)
+                self.first_frames.append(self.first_frames[-1] + layout["frames"])
+                self.step_runs.append(layout.get("step_runs"))
+                position += chunk_size
+        set_body_table(self, self.header)
+        self.position_precision = self.header["position_precision"]
+        self.velocity_precision = self.header["velocity_precision"]
+        self.chunks = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.first_frames[-1]
+
+    def get_chunk(self, k):
+        with self.lock:
+            frames = self.chunks.pop(k, None)
+            if frames is not None:
+                self.chunks[k] = frames
+                return frames
+        with open(self.path, "rb") as f:
+            f.seek(self.chunk_offsets[k])
+            data = f.read(self.chunk_sizes[k])
+        frames = framecodec.decode_chunk(data, self.dtype, self.position_precision, self.velocity_precision)
+        with self.lock:
+            self.chunks[k] = frames
+            while DeltaRecording.CACHED_CHUNKS < len(self.chunks):
+                self.chunks.popitem(last=False)
+        return frames
+
+    def get_frame(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("Frame {} of a recording of {}".format(index, len(self)))
+        k = bisect.bisect_right(self.first_frames, index) - 1
+        return self.get_chunk(k)[index - self.first_frames[k]]
+
+    def get_steps(self):
+        """
+        The simulation step of every frame, from the chunk layouts.
+        Chunks written without their steps listed are decoded.
+        """
+        steps = [self.get_chunk(k)["step"] if runs is None else framecodec.get_steps(runs)
+                 for k, runs in enumerate(self.step_runs)]
+        return np.concatenate(steps) if steps else np.zeros(0, dtype=np.int64)
+
+    def get_planets(self, index):
+        return get_planets(self, self.get_frame(index))
+
+    def close(self):
+        self.chunks.clear()
+
+
+READERS = {"raw": Recording,
+           "delta": DeltaRecording}
+
+
+def open_recording(path, offset=0, size=None):
+    """
+    Opens a recording with the reader for the codec it was written with.
+    """
+    with open(path, "rb") as f:
+        f.seek(offset)
+        header, _ = read_header(f)
+    codec = header.get("codec", "raw")
+    if codec not in READERS:
+        raise ValueError("Unknown recording codec {!r} in {}".format(codec, path))
+    return READERS[codec](path, offset, size)
+
+
+def is_recording(path):
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def get_zip_member_offset(path, info):
+    """
+    Where the data of a zip member starts in the archive.
+    """
+    with open(path, "rb") as f:
+        f.seek(info.header_offset)
+        local_header = f.read(30)
+    if local_header[:4] != "PK\x03\x04":
+        raise ValueError("Bad zip member header for {} in {}".format(info.filename, path))
+    name_length, extra_length = struct.unpack("<HH", local_header[26:30])
+    return info.header_offset + 30 + name_length + extra_length
+
+
+def open_zipped_recording(path, info):
+    """
+    Memory maps a recording stored uncompressed in a zip archive.
+    Compressed members cannot be read a frame at a time.
+    """
+    if info.compress_type != zipfile.ZIP_STORED:
+        raise ValueError("{} in {} is compressed; store recordings in zips uncompressed (zip -0)".format(
+            info.filename, path))
+    return open_recording(path, get_zip_member_offset(path, info), info.file_size)
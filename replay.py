@@ -10,8 +10,9 @@ import numpy as np
 from camera import Camera
 from utils import clean_filename
 import simulation
+from instrumentation import stats
+from tracing import tracer
 import simfileplayer
-import zipfile
 
 logs_directory = '/tmp/gravipy_log' or os.path.join(os.path.dirname(os.path.realpath(__file__)), 'log')
 
@@ -53,17 +54,14 @@ config = {
     "num_bg_stars": 20,
     "enable_movement": False}
 
+stats.configure(config)
+tracer.configure(config)
+
 black = 0, 0, 0
 
 pygame.init()
 
-if os.path.isdir("./tmp") is False:
-    os.mkdir("./tmp")
-
-with zipfile.ZipFile("recordings/test2.zip", "r") as myzip:
-    myzip.extractall("./tmp")
-
-sim = simfileplayer.GravitySimulationPlayer("tmp/recordings/test2.rec", config)
+sim = simfileplayer.GravitySimulationPlayer("recordings/test2.grec", config)
 cam = Camera(np.array([0, 0, 0]), config["dimensions"])
 
 screen = pygame.display.set_mode(config["dimensions"])
@@ -86,6 +84,7 @@ while 1:
     for event in pygame.event.get():
         log.debug("Handling pygame event {}".format(event.type))
         if event.type == pygame.QUIT:
+            sim.close()
             sys.exit()
 
         cam.handle_event(event)
@@ -100,5 +99,3 @@ while 1:
     sim.draw(screen, cam)
     pygame.display.flip()
     clock.tick(30)
-
-os.removedirs("./tmp")
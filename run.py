@@ -6,10 +6,13 @@ import sys
 import logging
 import time
 import os
+import random
 import numpy as np
 from camera import Camera
 from utils import clean_filename
 import simulation
+from instrumentation import stats
+from tracing import tracer
 
 logs_directory = '/tmp/gravipy_log' or os.path.join(os.path.dirname(os.path.realpath(__file__)), 'log')
 
@@ -47,13 +50,21 @@ config = {
     "gravitational_constant": 0.5,
     "draw_sphere_of_influence": False,
     "num_bg_stars": 250,
-    "enable_movement": False}
+    "enable_movement": False,
+    "force_solver": "direct",
+    "integrator": "euler",
+    "simulation_thread": False}
+
+stats.configure(config)
+tracer.configure(config)
 
 black = 0, 0, 0
 
 pygame.init()
 
-planets1 = simulation.generate_star_system_config("Sol", (0, 0, 0), 5)
+# with a "random_seed" in config every run starts from the same planets
+rng = random.Random(config.get("random_seed"))
+planets1 = simulation.generate_star_system_config("Sol", (0, 0, 0), 5, rng)
 # planets2 = simulation.generate_star_system_config("Sol", (-15000, 1000, 0), 2)
 # planets3 = simulation.generate_star_system_config("Sol", (8000, -10000, 4000), 1)
 # planets4 = simulation.generate_star_system_config("Sol", (-8000, 1000, 8000), 3)
@@ -61,9 +72,10 @@ planets1 = simulation.generate_star_system_config("Sol", (0, 0, 0), 5)
 # planets = planets1 + planets2 + planets3 + planets4 + planets5
 planets = planets1
 
-planets2 = simulation.generate_star_system_config("Sol", (10, 10, 0), 5)
+planets2 = simulation.generate_star_system_config("Sol", (10, 10, 0), 5, rng)
 
 sim = game.GravitySimulationSystem(planets, config)
+sim.start()
 cam = Camera(np.array([0, -5000, 300]), config["dimensions"])
 screen = pygame.display.set_mode(config["dimensions"])
 background = pygame.Surface(config["dimensions"])
@@ -88,6 +100,7 @@ while 1:
     for event in pygame.event.get():
         log.debug("Handling pygame event {}".format(event.type))
         if event.type == pygame.QUIT:
+            sim.stop()
             sys.exit()
 
         cam.handle_event(event)
@@ -4,11 +4,17 @@ __author__ = 'charles.andrew.parker@gmail.com'
 from objects import body
 import logging
 import itertools
+import math
+import threading
+import zipfile
+from collections import OrderedDict
 from coordinate import Coordinate
 from camera import Camera
 import pygame
 import simulation
+import recording
 import cPickle as pickle
+import numpy as np
 
 log = logging.getLogger(__name__)
 log.setLevel(logging.DEBUG)
@@ -29,54 +35,304 @@ class FrameWarp(object):
     pygame.draw.rect(pause_image, framewarp_arrow_color, (8, 8, 56, 34))
 
     @classmethod
-    def build_timewarp_image(cls, timewarp_num):
-        if timewarp_num == 0:
+    def build_timewarp_image(cls, timewarp_value):
+        """
+        One arrow per whole step of timewarp plus a narrower one for
+        any fraction, pointing back for reverse play.
+        """
+        if timewarp_value == 0:
             return FrameWarp.pause_image
 
         else:
-            image_size = timewarp_num * cls.arrow_size[0], cls.arrow_size[1]
-            image = pygame.Surface(image_size)
-            for n in range(timewarp_num):
+            whole, fraction = divmod(abs(timewarp_value), 1)
+            width = int((whole + fraction) * cls.arrow_size[0])
+            image = pygame.Surface((width, cls.arrow_size[1]))
+            image.fill(cls.framewarp_image_bgcolor)
+            for n in range(int(whole)):
                 image.blit(cls.arrow_image, (n * cls.arrow_size[0], 0))
+            if 0 < fraction:
+                partial = pygame.transform.scale(cls.arrow_image, (int(fraction * cls.arrow_size[0]), cls.arrow_size[1]))
+                image.blit(partial, (int(whole) * cls.arrow_size[0], 0))
 
+            if timewarp_value < 0:
+                image = pygame.transform.flip(image, True, False)
             return image
 
-    def __init__(self, frames, max_timewarp):
-        self.frames = [pickle.loads(f) for f in frames]
-        self.num_frames = len(frames)
+    def __init__(self, frames, max_timewarp, slow_rates=(0.25, 0.5)):
+        """
+        timewarp_value is the number of recorded simulation steps
+        played per displayed frame.  It steps through slow_rates and
+        the whole numbers below max_timewarp, forwards and in reverse.
+        """
+        self.frames = frames
+        self.num_frames = len(frames.source)
+        self.interval = getattr(frames.source, "interval", 1)
+        self.steps = frames.source.get_steps()
+        self.step = float(self.steps[0])
         self.frame_index = 0
+        self.fraction = 0.0
         self.timewarp_value = 1
         self.max_timewarp = max_timewarp
-        self.images = [FrameWarp.build_timewarp_image(n) for n in range(0, max_timewarp)]
+        forward = sorted(slow_rates) + range(1, max_timewarp)
+        self.rates = [-r for r in reversed(forward)] + [0] + forward
+        self.images = dict((r, FrameWarp.build_timewarp_image(r)) for r in self.rates)
 
     def get_timewarp_image(self):
+        if self.timewarp_value not in self.images:
+            self.images[self.timewarp_value] = FrameWarp.build_timewarp_image(self.timewarp_value)
         return self.images[self.timewarp_value]
 
     def increment_timewarp(self):
-        if self.timewarp_value < self.max_timewarp - 1:
-            self.timewarp_value += 1
+        faster = [r for r in self.rates if self.timewarp_value < r]
+        if faster:
+            self.timewarp_value = faster[0]
 
     def decrement_timewarp(self):
-        if -1 * self.max_timewarp + 1 < self.timewarp_value:
-            self.timewarp_value -= 1
+        slower = [r for r in self.rates if r < self.timewarp_value]
+        if slower:
+            self.timewarp_value = slower[-1]
 
     def next_frame(self):
-        self.frame_index += self.timewarp_value
-        if self.frame_index < 0:
-            self.frame_index += self.num_frames
-        elif self.num_frames <= self.frame_index:
-            self.frame_index -= self.num_frames
+        """
+        Moves the play position on by timewarp_value simulation steps
+        and finds the recorded frames either side of it by their step,
+        so stretches where frames were dropped play at the same speed.
+        The last frame is held for interval steps before play wraps
+        around to the first.
+        """
+        first = self.steps[0]
+        length = self.steps[-1] - first + self.interval
+        self.step = first + (self.step + self.timewarp_value - first) % length
+        self.frame_index = int(np.searchsorted(self.steps, self.step, side='right')) - 1
+        self.fraction = 0.0
+        if self.frame_index + 1 < self.num_frames:
+            before, after = self.steps[self.frame_index], self.steps[self.frame_index + 1]
+            self.fraction = (self.step - before) / float(after - before)
+
+    def get_prefetch_step(self):
+        frames_per_update = float(self.timewarp_value) / self.interval
+        if frames_per_update == 0:
+            return 0
+        return int(math.copysign(max(1, round(abs(frames_per_update))), frames_per_update))
 
     def get_frame(self):
         self.next_frame()
-        return self.frames[self.frame_index]
+        if self.fraction == 0:
+            return self.frames.get(self.frame_index, self.get_prefetch_step())
+        return self.frames.get_interpolated(self.frame_index, self.fraction, self.get_prefetch_step())
+
+
+class PickledFrames(object):
+    """
+    A legacy recording: a pickled list of pickled frames.  Each
+    frame is only unpickled into planets when it is asked for.
+    """
+
+    interval = 1
+
+    def __init__(self, data):
+        self.frames = pickle.loads(data)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def get_steps(self):
+        return np.arange(len(self.frames)) * PickledFrames.interval
+
+    def get_planets(self, index):
+        """
+        Legacy frames carry no body ids, so the planets are told apart
+        by name and by which of the planets with that name they are.
+        That goes wrong when a body that shares its name is merged away.
+        """
+        planets = pickle.loads(self.frames[index])
+        seen = {}
+        for p in planets:
+            p.recording_id = (p.name, seen.get(p.name, 0))
+            seen[p.name] = p.recording_id[1] + 1
+        return planets
+
+
+def open_frames(savefile_path):
+    """
+    The frames of a recording, as a source with a length and
+    get_planets(index).  Columnar recordings are memory mapped, from
+    the file or from an uncompressed member of a zip; legacy pickled
+    recordings are read from the .rec file or out of the zip.
+    Nothing is extracted to disk.
+    """
+    if recording.is_recording(savefile_path):
+        return recording.open_recording(savefile_path)
+    if zipfile.is_zipfile(savefile_path):
+        with zipfile.ZipFile(savefile_path, "r") as myzip:
+            for info in myzip.infolist():
+                if info.filename.endswith(".grec"):
+                    return recording.open_zipped_recording(savefile_path, info)
+            for info in myzip.infolist():
+                if info.filename.endswith(".rec"):
+                    return PickledFrames(myzip.read(info))
+        raise ValueError("No recording in {}".format(savefile_path))
+    with open(savefile_path, "rb") as f:
+        return PickledFrames(f.read())
+
+
+class FrameCache(object):
+    """
+    The most recently used frames of a recording, at most `size` of
+    them, oldest dropped first: the decoded frames of a columnar
+    recording, which interpolation reads, and the planets of the
+    frames shown whole.
+
+    After every get a prefetch thread decodes the next `prefetch`
+    frames the player will ask for at its current timewarp, going
+    backwards through the recording when it plays in reverse.
+    Legacy recordings only hold planets, so those are prefetched.
+    """
+
+    def __init__(self, source, size=256, prefetch=32):
+        self.source = source
+        self.prefetch = prefetch
+        self.size = max(size, prefetch + 1)
+        self.frames = OrderedDict()
+        self.raw_frames = OrderedDict()
+        self.has_raw_frames = hasattr(source, "get_frame")
+        self.lock = threading.Lock()
+        self.requested = threading.Condition(self.lock)
+        self.request = None
+        self.stopped = False
+        self.decoded = 0
+        self.prefetcher = threading.Thread(target=self.run_prefetch, name="frame-prefetch")
+        self.prefetcher.daemon = True
+        if 0 < prefetch:
+            self.prefetcher.start()
+
+    def __len__(self):
+        return len(self.frames)
+
+    def lookup(self, index, cache=None):
+        """
+        The cached entry for frame index, marked as most recently
+        used, or None.  The caller holds the lock.
+        """
+        cache = self.frames if cache is None else cache
+        entry = cache.pop(index, None)
+        if entry is not None:
+            cache[index] = entry
+        return entry
+
+    def insert(self, index, entry, cache=None):
+        cache = self.frames if cache is None else cache
+        self.decoded += 1
+        cache[index] = entry
+        while self.size < len(cache):
+            cache.popitem(last=False)
+
+    def decode(self, index):
+        """
+        What the prefetcher keeps for frame index: the decoded frame
+        of a columnar recording, the planets of a legacy one.
+        """
+        if self.has_raw_frames:
+            return np.array(self.source.get_frame(index))
+        return self.source.get_planets(index)
+
+    def get_raw_frame(self, index):
+        """
+        The decoded frame index of a columnar recording.
+        """
+        with self.lock:
+            frame = self.lookup(index, self.raw_frames)
+        if frame is None:
+            frame = self.decode(index)
+            with self.lock:
+                self.insert(index, frame, self.raw_frames)
+        return frame
+
+    def get(self, index, step=1):
+        """
+        The planets of frame index, then prefetches the frames
+        index + step, index + 2 * step, ... wrapping around the ends.
+        """
+        with self.lock:
+            planets = self.lookup(index)
+        if planets is None:
+            if self.has_raw_frames:
+                planets = recording.get_planets(self.source, self.get_raw_frame(index))
+            else:
+                planets = self.source.get_planets(index)
+            with self.lock:
+                self.insert(index, planets)
+
+        self.request_prefetch(index, step)
+        return planets
+
+    def get_interpolated(self, index, fraction, step=1):
+        """
+        The planets a fraction of the way from frame index to the
+        next.  Legacy recordings only hold planets, so their frames
+        are shown whole.
+        """
+        if not self.has_raw_frames:
+            return self.get(index, step)
+        frame = recording.interpolate_frames(self.get_raw_frame(index), self.get_raw_frame(index + 1), fraction)
+        self.request_prefetch(index, step)
+        return recording.get_planets(self.source, frame)
+
+    def request_prefetch(self, index, step):
+        with self.lock:
+            self.request = (index, step)
+            self.requested.notify()
+
+    def get_prefetch_indices(self, index, step):
+        """
+        The frames to decode ahead of index, with the frame after each
+        for interpolating towards it.
+        """
+        if step == 0:
+            return []
+        num_frames = len(self.source)
+        indices = []
+        for k in range(1, min(self.prefetch, num_frames - 1) + 1):
+            for i in (index + k * step, index + k * step + 1):
+                if (i % num_frames) not in indices:
+                    indices.append(i % num_frames)
+        return indices[:self.prefetch]
+
+    def run_prefetch(self):
+        while True:
+            with self.lock:
+                while self.request is None and not self.stopped:
+                    self.requested.wait()
+                if self.stopped:
+                    return
+                request, self.request = self.request, None
+
+            cache = self.raw_frames if self.has_raw_frames else self.frames
+            for index in self.get_prefetch_indices(*request):
+                with self.lock:
+                    # a newer request means the player has moved on
+                    if self.stopped or self.request is not None:
+                        break
+                    if self.lookup(index, cache) is not None:
+                        continue
+                entry = self.decode(index)
+                with self.lock:
+                    self.insert(index, entry, cache)
+
+    def close(self):
+        with self.lock:
+            self.stopped = True
+            self.requested.notify()
+        if self.prefetcher.is_alive():
+            self.prefetcher.join()
 
 
 class GravitySimulationPlayer(object):
     def __init__(self, savefile_path, sim_config):
-        with open(savefile_path, "r") as f:
-            frames = pickle.load(f)
-            self.time_handler = FrameWarp(frames, 8)
+        self.frames = FrameCache(open_frames(savefile_path),
+                                 sim_config.get("replay_cache_frames", 256),
+                                 sim_config.get("replay_prefetch_frames", 32))
+        self.time_handler = FrameWarp(self.frames, 8)
 
         self.sim = simulation.GravitySimulation(planet_configs=None, sim_config=sim_config)
 
@@ -94,9 +350,6 @@ class GravitySimulationPlayer(object):
             if event.key == pygame.K_PERIOD:
                 self.time_handler.increment_timewarp()
 
-        if event.type == Camera.CAMERAEVENT and event.movement == Camera.CAMERAMOVED:
-            self.sim.clear_planet_trails()
-
     def draw_background(self, surface, camera):
         log.info("Drawing Background")
         self.sim.draw_background(surface, camera)
@@ -118,3 +371,6 @@ class GravitySimulationPlayer(object):
         self.draw_planets(surface, camera)
         self.draw_timewarp_image(surface)
 
+    def close(self):
+        self.frames.close()
+
@@ -4,14 +4,14 @@ from utils import clean_filename
 import logging
 import time
 import os
+import random
 import numpy as np
 from camera import Camera
 import game
 import simulation
+from instrumentation import stats
+from tracing import tracer
 import simfileplayer
-import cPickle as pickle
-import copy
-import zipfile
 
 logs_directory = '/tmp/gravipy_log' or os.path.join(os.path.dirname(os.path.realpath(__file__)), 'log')
 
@@ -49,13 +49,21 @@ config = {
     "gravitational_constant": 0.5,
     "draw_sphere_of_influence": False,
     "num_bg_stars": 250,
-    "enable_movement": False}
-
-planets1 = simulation.generate_star_system_config("Sol", (0, 0, 0), 5)
-planets2 = simulation.generate_star_system_config("Sol", (-15000, 1000, 0), 5)
-planets3 = simulation.generate_star_system_config("Sol", (8000, -10000, 4000), 5)
-planets4 = simulation.generate_star_system_config("Sol", (-8000, 1000, 8000), 5)
-planets5 = simulation.generate_star_system_config("Sol", (4000, -4000, 4000), 1)
+    "enable_movement": False,
+    "recording_codec": "delta",
+    "recording_interval": 5,
+    "recording_encoder_threads": 2}
+
+stats.configure(config)
+tracer.configure(config)
+
+# with a "random_seed" in config every run starts from the same planets
+rng = random.Random(config.get("random_seed"))
+planets1 = simulation.generate_star_system_config("Sol", (0, 0, 0), 5, rng)
+planets2 = simulation.generate_star_system_config("Sol", (-15000, 1000, 0), 5, rng)
+planets3 = simulation.generate_star_system_config("Sol", (8000, -10000, 4000), 5, rng)
+planets4 = simulation.generate_star_system_config("Sol", (-8000, 1000, 8000), 5, rng)
+planets5 = simulation.generate_star_system_config("Sol", (4000, -4000, 4000), 1, rng)
 
 planets = planets1 + planets2 + planets3 + planets4 + planets5
 # planets = planets1
@@ -67,19 +75,11 @@ if __name__ == "__main__":
     if os.path.isdir("recordings") is False:
         os.mkdir("recordings")
 
-    with open("recordings/test2.rec", "w") as f:
-        states = [None for _ in range(0, 1500)]
+    sim.start_recording("recordings/test2.grec", metadata=config)
+    try:
         for _ in range(0, 1500):
             if _ % 15 == 0:
                 print _ / 15
             sim.update_planets(1)
-            states[_] = pickle.dumps(sim.get_planet_simulation_state())
-        pickle.dump(states, f)
-
-    with open("recordings/test2.rec", "r") as f:
-        states = pickle.load(f)
-
-    with zipfile.ZipFile('recordings/test2.zip', 'w', zipfile.ZIP_DEFLATED) as myzip:
-        myzip.write('recordings/test2.rec')
-
-
+    finally:
+        sim.close()
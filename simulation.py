@@ -2,27 +2,37 @@ __author__ = 'charles.andrew.parker@gmail.com'
 
 from coordinate import Coordinate
 from objects import body
+from bodystore import BodyStore
+import solvers
+import integrators
+import collisions
+from instrumentation import stats
+from skypanorama import SkyPanorama
+from framebuffer import FramebufferRenderer
+from trails import TrailBuffer
+from recording import get_recorder
+import checkpoint
 import random
 import logging
+import os
 import numpy as np
 import math
-import itertools
 
 log = logging.getLogger(__name__)
 log.setLevel(logging.DEBUG)
 
-def generate_planet(base_star, radius, name):
+def generate_planet(base_star, radius, name, rng=random):
     offset = base_star["pos"]
-    angle = random.randrange(0, 360)
+    angle = rng.randrange(0, 360)
     angle = math.pi * angle / 180.0
     pos = np.array(offset) + radius * np.array([math.cos(angle),
                                                 math.sin(angle),
-                                                random.uniform(-math.pi / 24, math.pi / 24)])
+                                                rng.uniform(-math.pi / 24, math.pi / 24)])
     vel = base_star["vel"] + get_velocity_for_circular_orbit(base_star, pos)
-    mass = random.randrange(10000, 300000)
+    mass = rng.randrange(10000, 300000)
 
     def rand_clr():
-        return random.randrange(0, 255)
+        return rng.randrange(0, 255)
 
     color = (rand_clr(), rand_clr(), rand_clr())
 
@@ -33,10 +43,10 @@ def generate_planet(base_star, radius, name):
             "vel": vel}
 
 
-def generate_star_system_config(base_name, offset, num_planets):
+def generate_star_system_config(base_name, offset, num_planets, rng=random):
     star = {
         "name": base_name,
-        "mass": random.randrange(1000000, 8000000),
+        "mass": rng.randrange(1000000, 8000000),
         "pos": offset,
         "color": (255, 255, 190),
         "vel": (0, 0, 0)}
@@ -45,7 +55,8 @@ def generate_star_system_config(base_name, offset, num_planets):
     for r in range(num_planets):
         new_planet = generate_planet(star,
                                      1000 * (r + 1),
-                                     "{}-{}".format(star["name"], r+1))
+                                     "{}-{}".format(star["name"], r+1),
+                                     rng)
         planet_list.append(new_planet)
 
     return planet_list
@@ -60,27 +71,89 @@ def get_velocity_for_circular_orbit(parent, pos):
     return speed * vel_norm
 
 
-def generate_background_star_field(num_stars):
+def generate_background_star_field(num_stars, rng=random):
     star_list = []
     for _ in range(num_stars):
-        args = {"pos": Coordinate.get_random_coordinate(10000000.0),
+        args = {"pos": Coordinate.get_random_coordinate(10000000.0, rng),
                 "vel": Coordinate.get_empty_coord(),
-                "radius": random.randrange(1, 3)}
+                "radius": rng.randrange(1, 3)}
         star_list.append(args)
     return star_list
 
 
+def get_planet_renderer(sim_config):
+    """
+    None for drawing each planet with pygame calls, otherwise
+    the renderer that draws them all at once.
+    """
+    name = sim_config.get("planet_renderer", "circles")
+    if name == "circles":
+        return None
+    elif name == "framebuffer":
+        return FramebufferRenderer(sim_config)
+    raise ValueError("Unknown planet renderer {}; expected circles or framebuffer".format(name))
+
+
+class SimulationSnapshot(object):
+    """
+    The drawable state of a simulation between two steps.  Positions
+    and radii are copies, so the simulation can keep stepping while a
+    snapshot is drawn; the bodies themselves are shared and only
+    their names and colors should be read from them.
+    """
+
+    def __init__(self, store, steps, sim_time, previous=None):
+        self.pos = store.pos.copy()
+        self.radius = store.radius.copy()
+        # share the previous snapshot's body list while no bodies have
+        # come or gone, so per-body caches keyed on it stay valid
+        if previous is not None and previous.store_bodies is store.bodies and len(previous) == len(store):
+            self.bodies = previous.bodies
+        else:
+            self.bodies = list(store.bodies)
+        self.store_bodies = store.bodies
+        self.steps = steps
+        self.sim_time = sim_time
+
+    def __len__(self):
+        return len(self.bodies)
+
+
 class GravitySimulation(object):
     def __init__(self, planet_configs, sim_config):
         self.sim_config = sim_config
         self.planet_configs = planet_configs
-        self.planets = set()
+        self.store = BodyStore()
         self.background_stars = set()
+        self.background_star_arrays = None
+        self.sky_panorama = None
+        self.solver = solvers.get_solver(sim_config)
+        self.integrator = integrators.get_integrator(sim_config)
+        self.accelerations_current = False
+        self.broadphase = collisions.get_broadphase(sim_config)
+        self.collisions = np.zeros((0, 2), dtype=int)
+        self.trails = TrailBuffer(sim_config.get("trail_length", 40), sim_config.get("trail_interval", 1))
+        self.sample_trails = True
+        self.last_snapshot = None
+        self.recorder = None
+        # this simulation's own generators, seeded by random_seed
+        self.random = random.Random(sim_config.get("random_seed"))
+        self.np_random = np.random.RandomState(sim_config.get("random_seed"))
+        self.steps = 0
+        self.sim_time = 0.0
         self.create_simulation(self.planet_configs, self.sim_config)
-        self.planet_distances = {}
-        self.update_distance_and_vectors_for_planets()
         self.BIG_G = sim_config["gravitational_constant"]
         self.DRAW_SOI = sim_config["draw_sphere_of_influence"]
+        self.PANORAMA_MIN_STARS = sim_config.get("sky_panorama_min_stars", 10000)
+        self.renderer = get_planet_renderer(sim_config)
+        self.checkpoint_path = sim_config.get("checkpoint_path")
+        self.checkpoint_interval = sim_config.get("checkpoint_interval", 10000)
+        if sim_config.get("recording_path") is not None:
+            self.start_recording(sim_config["recording_path"])
+
+    @property
+    def planets(self):
+        return self.store.bodies
 
     def set_planets(self, planets):
         """
@@ -88,106 +161,312 @@ class GravitySimulation(object):
         to run the sumulation, just set the planets to a saved
         set
         """
-        self.planets = planets
+        self.store.clear()
+        self.store = BodyStore(planets)
+        self.accelerations_current = False
+        self.trails.sample(self.store)
 
     def get_planet_simulation_state(self):
         return [p for p in self.planets]
 
+    def take_snapshot(self):
+        self.last_snapshot = SimulationSnapshot(self.store, self.steps, self.sim_time, self.last_snapshot)
+        return self.last_snapshot
+
+    def start_recording(self, path, metadata=None):
+        """
+        Streams every recording_interval-th step to a columnar
+        recording at path until stop_recording is called.
+        """
+        self.stop_recording()
+        self.recorder = get_recorder(path, self, metadata)
+
+    def stop_recording(self):
+        if self.recorder is not None:
+            try:
+                self.recorder.close()
+            finally:
+                self.recorder = None
+
+    def close(self):
+        """
+        Stops recording and releases the solver's worker processes,
+        if it has any.  Stepping again restarts them.
+        """
+        try:
+            self.stop_recording()
+        finally:
+            close_solver = getattr(self.solver, "close", None)
+            if close_solver is not None:
+                close_solver()
+
+    def save_checkpoint(self, path):
+        """
+        Saves everything needed to carry on exactly where the run is:
+        the bodies, the step count and time, the integrator's and the
+        solver's state, the background stars and the state of its
+        random generators.
+        """
+        rng_meta, arrays = checkpoint.get_rng_state(self.random, self.np_random)
+        integrator_meta, integrator_arrays = checkpoint.get_state(self.integrator, "integrator_")
+        arrays.update(integrator_arrays)
+        solver_meta, solver_arrays = checkpoint.get_state(self.solver, "solver_")
+        arrays.update(solver_arrays)
+        stars, star_pos, star_radius = self.get_background_star_arrays()
+        arrays.update(pos=self.store.pos, vel=self.store.vel, acc=self.store.acc,
+                      mass=self.store.mass, radius=self.store.radius,
+                      color=np.array([b.color for b in self.planets], dtype=np.uint8).reshape(-1, 3),
+                      star_pos=star_pos, star_radius=star_radius)
+        meta = {"steps": self.steps,
+                "sim_time": self.sim_time,
+                "names": [b.name for b in self.planets],
+                "accelerations_current": self.accelerations_current,
+                "integrator": self.integrator.name,
+                "integrator_state": integrator_meta,
+                "solver": self.solver.name,
+                "solver_state": solver_meta,
+                "sim_config": self.sim_config,
+                "planet_configs": self.planet_configs}
+        meta.update(rng_meta)
+        checkpoint.write_checkpoint(path, meta, arrays)
+
+    @classmethod
+    def load_checkpoint(cls, path, sim_config=None):
+        """
+        A simulation restored from save_checkpoint, stepping on
+        exactly as the saved one would have.  sim_config overrides
+        the saved config, but must use the same integrator.  The saved
+        run's recording and checkpoint paths are not reused, so the
+        restored simulation writes nothing unless sim_config says where.
+        """
+        meta, arrays = checkpoint.read_checkpoint(path)
+        config = dict(meta["sim_config"])
+        config.pop("recording_path", None)
+        config.pop("checkpoint_path", None)
+        config.update(sim_config or {})
+        if config.get("integrator", integrators.EulerIntegrator.name) != meta["integrator"]:
+            raise ValueError("{} was saved with the {} integrator".format(path, meta["integrator"]))
+
+        sim = cls(None, dict(config, num_bg_stars=0, recording_path=None))
+        sim.sim_config = config
+        sim.planet_configs = meta["planet_configs"]
+        sim.set_planets([body.Planet(name=name, pos=arrays["pos"][i], vel=arrays["vel"][i],
+                                     mass=float(arrays["mass"][i]), color=tuple(int(c) for c in arrays["color"][i]))
+                         for i, name in enumerate(meta["names"])])
+        sim.store.acc = arrays["acc"]
+        sim.store.radius = arrays["radius"]
+        sim.background_stars = set(body.BackgroundStar(pos=pos, vel=Coordinate.get_empty_coord(), radius=radius)
+                                   for pos, radius in zip(arrays["star_pos"], arrays["star_radius"]))
+        sim.background_star_arrays = None
+        sim.steps = meta["steps"]
+        sim.sim_time = meta["sim_time"]
+        sim.accelerations_current = meta["accelerations_current"]
+        checkpoint.set_state(sim.integrator, meta["integrator_state"], arrays, "integrator_")
+        # a different solver starts afresh
+        if meta.get("solver") == sim.solver.name:
+            checkpoint.set_state(sim.solver, meta["solver_state"], arrays, "solver_")
+        checkpoint.set_rng_state(meta, arrays, sim.random, sim.np_random)
+        if config.get("recording_path") is not None:
+            sim.start_recording(config["recording_path"])
+        return sim
+
+    @classmethod
+    def fork_checkpoint(cls, path, count, velocity_perturbation=1e-9, seed=0, sim_config=None):
+        """
+        count simulations restored from one checkpoint that go their
+        own ways: fork k has its own random generators seeded with
+        seed + k, and every velocity scaled by 1 + velocity_perturbation
+        times a standard normal drawn from them.  With no perturbation
+        the forks step identically and differ only in what their
+        generators draw, such as the star field on a reset.
+
+        A checkpoint_path or recording_path in sim_config gets a
+        "-k" suffix for fork k, so the forks don't overwrite each other.
+        """
+        forks = []
+        for k in range(count):
+            fork_config = dict(sim_config or {})
+            for key in ("checkpoint_path", "recording_path"):
+                if fork_config.get(key) is not None:
+                    root, ext = os.path.splitext(fork_config[key])
+                    fork_config[key] = "{}-{}{}".format(root, k, ext)
+            sim = cls.load_checkpoint(path, fork_config)
+            sim.random = random.Random(seed + k)
+            sim.np_random = np.random.RandomState(seed + k)
+            sim.store.vel *= 1 + velocity_perturbation * sim.np_random.standard_normal(sim.store.vel.shape)
+            forks.append(sim)
+        return forks
+
     def create_simulation(self, planet_configs, sim_config):
         log.info("Creating simulation.")
-        self.planets = set()
+        # a recording holds a fixed set of bodies
+        self.stop_recording()
+        self.store.clear()
+        self.store = BodyStore()
         if planet_configs is not None:
             for p in planet_configs:
-                self.planets.add(body.Planet(**p))
+                self.store.add(body.Planet(**p))
+        self.accelerations_current = False
+        self.trails.clear()
+        self.steps = 0
+        self.sim_time = 0.0
 
-        for s in generate_background_star_field(sim_config["num_bg_stars"]):
+        for s in generate_background_star_field(sim_config["num_bg_stars"], self.random):
             self.background_stars.add(body.BackgroundStar(**s))
 
     def reset(self):
+        self.close()
         self.create_simulation(self.planet_configs, self.sim_config)
 
     def update_distance_and_vectors_for_planets(self):
         """
-        builds a dict of radius vectors between planets
-        of format:
-        {
-            (p1, p2): distance from p1 to p2,
-            (p1, p3): distance from p1 to p3,
-            ...
-            (p3, p4): distance from p3 to p4, etc.
-        }
+        Finds every pair of bodies whose radii overlap, using the
+        broadphase chosen by sim_config["collision_broadphase"].
         """
-        self.planet_distances = {}
-        for a, b in itertools.combinations(self.planets, 2):
-            dist, vect = Coordinate.get_distance_and_radius_vector(a.coord, b.coord)
-            self.planet_distances[(a, b)] = (dist, vect)
+        self.collisions = collisions.find_overlapping_pairs(self.store.pos, self.store.radius, self.broadphase)
 
     def update_positions(self, dt):
-        for p in self.planets:
-            p.coord.update_vel(dt)
+        self.store.pos += dt * self.store.vel
 
     def update_velocities(self, dt):
-        for p in self.planets:
-            p.coord.update_pos(dt)
+        self.store.vel += dt * self.store.acc
 
     def update_acceleration(self):
-        dead_planets = set()
-        for p in self.planets:
-            p.coord.zero_acc()
-
-        for planets, distances in self.planet_distances.items():
-                a, b = planets
-                dist, vect = distances
-
-                acc = self.BIG_G * a.mass * b.mass * vect / dist ** 3
-
-                a.coord.update_acc(acc/a.mass)
-                b.coord.update_acc(-acc/b.mass)
+        """
+        Evaluates the accelerations for the current positions.
+        Integrators may call this several times per step.
+        """
+        with stats.phase("force"):
+            self.store.acc = 0.0
+            self.solver.compute_accelerations(self.store, self.BIG_G)
+        stats.count("pairs_evaluated", self.solver.pairs_evaluated)
+        self.accelerations_current = True
 
-                if dist < body.Planet.get_collision_distance(a, b):
-                    dead_planets.add(body.Planet.handle_collision(a, b))
+    def handle_collisions(self):
+        """
+        Merges every connected group of overlapping bodies at once,
+        so chains of collisions resolve the same way regardless of
+        the order the pairs were found in.
+        """
+        survivors, absorbed = collisions.merge_groups(self.store.mass, self.store.vel, self.collisions)
+        for i in survivors:
+            self.planets[i].get_radius(update=True)
+            self.planets[i].get_sphere_of_influence(update=True)
 
-        self.delete_dead_planets(dead_planets)
+        self.delete_dead_planets([self.planets[i] for i in absorbed])
 
     def delete_dead_planets(self, dead_planets):
-        for p in dead_planets:
-            self.planets.remove(p)
+        if len(dead_planets) > 0:
+            self.store.remove([p.coord.index for p in dead_planets])
+            self.accelerations_current = False
 
     def handle_event(self, event):
         pass
 
     def update_planets(self, dt):
         log.info("UPDATING DISTANCES AND RADIUS VECTORS")
-        self.update_distance_and_vectors_for_planets()
-        log.info("UPDATING FORCES/ACCELERATION")
-        self.update_acceleration()
-        log.info("UPDATING VELOCITIES")
-        self.update_velocities(dt)
-        log.info("UPDATING POSITIONS")
-        self.update_positions(dt)
+        with stats.phase("distance"):
+            self.update_distance_and_vectors_for_planets()
+        log.info("HANDLING COLLISIONS")
+        with stats.phase("collision"):
+            self.handle_collisions()
+        log.info("INTEGRATING")
+        with stats.phase("integrate"):
+            self.integrator.step(self, dt)
+        self.steps += 1
+        self.sim_time += dt
+        if self.sample_trails is True:
+            self.trails.sample(self.store)
+        if self.recorder is not None:
+            with stats.phase("record"):
+                self.recorder.record(self)
+        if self.checkpoint_path is not None and self.steps % self.checkpoint_interval == 0:
+            self.save_checkpoint(self.checkpoint_path)
+        stats.count("bodies", len(self.store))
+        stats.tick()
+
+    def get_background_star_arrays(self):
+        """
+        The background stars as a list with matching position and
+        radius arrays, rebuilt only when the star field changes.
+        """
+        if self.background_star_arrays is None or len(self.background_star_arrays[0]) != len(self.background_stars):
+            stars = list(self.background_stars)
+            self.background_star_arrays = (stars,
+                                           np.array([s.coord.pos for s in stars], dtype=float).reshape(-1, 3),
+                                           np.array([s.radius for s in stars], dtype=float))
+        return self.background_star_arrays
+
+    def get_sky_panorama(self, camera):
+        """
+        The background stars pre-rendered for this camera's screen,
+        rebuilt only when the star field or the screen changes.
+        """
+        stars, pos, radius = self.get_background_star_arrays()
+        if self.sky_panorama is None or self.sky_panorama[0] is not stars or not self.sky_panorama[1].matches(camera):
+            log.info("Rendering sky panorama of {} stars".format(len(stars)))
+            self.sky_panorama = (stars, SkyPanorama(camera, pos, radius, [s.color for s in stars]))
+        return self.sky_panorama[1]
 
     def draw_background(self, surface, camera):
+        """
+        Large star fields are drawn from a pre-rendered panorama,
+        whose cost doesn't grow with sim_config["num_bg_stars"];
+        smaller ones are projected and drawn star by star.
+        """
         log.info("Drawing Background")
-        surface.fill((0, 0, 0))
-        for p in self.background_stars:
-            log.debug("P {}".format(p.coord.pos))
-            p.draw(surface, camera)
-
-    def draw_planets(self, surface, camera):
+        with stats.phase("draw_background"):
+            stars, pos, radius = self.get_background_star_arrays()
+            if self.PANORAMA_MIN_STARS <= len(stars):
+                self.get_sky_panorama(camera).draw(surface, camera)
+                return
+
+            surface.fill((0, 0, 0))
+            _, screen_pos, visible = camera.project(pos, radius)
+            screen_pos = screen_pos.tolist()
+            for i in np.nonzero(visible)[0]:
+                stars[i].draw_projected(surface, screen_pos[i])
+
+    def draw_planets(self, surface, camera, snapshot=None):
+        """
+        Draws the planets as they are now or, given a snapshot
+        from take_snapshot(), as they were then.
+        """
         log.info("Drawing planets")
+        source = self.store if snapshot is None else snapshot
+
+        with stats.phase("draw_planets"):
+            planets = source.bodies
+            self.trails.draw(surface, camera)
+            if self.renderer is not None:
+                points, discs = self.renderer.draw(surface, camera, source, self.DRAW_SOI)
+                drawn = points + discs
+                stats.count("bodies_drawn_as_points", points)
+                stats.count("bodies_drawn", drawn)
+                stats.count("bodies_culled", len(planets) - drawn)
+                return
+
+            r, screen_pos, visible = camera.project(source.pos, source.radius)
+            screen_pos = screen_pos.tolist()
+            if self.DRAW_SOI is True:
+                soi = np.array([p.get_sphere_of_influence() for p in planets], dtype=float)
+                soi_r, soi_pos, soi_visible = camera.project(source.pos, soi)
+                soi_pos = soi_pos.tolist()
 
-        # build ordered list
-        ordered_list = []
-        for p in self.planets:
-            dist, _ = Coordinate.get_distance_and_radius_vector(camera.coord, p.coord)
-            ordered_list.append((p, dist))
+            # draw from farthest to nearest
+            vect = source.pos - camera.coord.pos
+            dist_sq = np.einsum('ij,ij->i', vect, vect)
 
-        for p, d in sorted(ordered_list, key=lambda ele: ele[1], reverse=True):
-            p.draw(surface, camera)
+            drawn = 0
+            for i in np.argsort(-dist_sq, kind='mergesort'):
+                if visible[i] and planets[i].draw_projected(surface, r[i], screen_pos[i]) is True:
+                    drawn += 1
 
-            if self.DRAW_SOI is True:
-                p.draw_sphere_of_influence(surface, camera)
+                if self.DRAW_SOI is True and soi_visible[i]:
+                    planets[i].draw_sphere_of_influence_projected(surface, soi_r[i], soi_pos[i])
+
+        stats.count("bodies_drawn", drawn)
+        stats.count("bodies_culled", len(planets) - drawn)
 
     def clear_planet_trails(self):
-        for p in self.planets:
-            p.clear_planet_trail()
+        self.trails.clear()
@@ -0,0 +1,136 @@
+__author__ = 'charles.andrew.parker@gmail.com'
+
+import logging
+import math
+import numpy as np
+import pygame
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+
+def get_directions(positions, center):
+    """
+    Unit vectors from center towards each position.
+    """
+    vect = np.asarray(positions, dtype=float).reshape(-1, 3) - center
+    return vect / np.sqrt(np.einsum('ij,ij->i', vect, vect))[:, np.newaxis]
+
+
+class SkyPanorama(object):
+    """
+    The background star field rendered once into an equirectangular
+    panorama of palette indices, one row per step of polar angle and
+    one column per step of azimuth.
+
+    The stars are far enough away that only their direction matters,
+    so drawing the background for any pitch and yaw is a lookup of
+    every screen pixel's viewing ray in the panorama.  That costs the
+    same whether there are 250 stars or 100k.  Panorama pixels are as
+    wide as a screen pixel at the centre of the view.
+    """
+
+    def __init__(self, camera, positions, radii, colors):
+        self.screen_dims = tuple(camera.screen_dims)
+        self.projection_plane_distance = camera.projection_plane_distance
+        self.rows = int(math.ceil(math.pi * self.projection_plane_distance))
+        self.columns = 2 * self.rows
+        self.rays = self.get_camera_rays()
+        # the panorama pixel behind each screen pixel, for the last view drawn
+        self.view_basis = None
+        self.view_pixels = None
+
+        colors = np.array(colors, dtype=int).reshape(-1, 3)
+        self.palette = np.zeros((0, 3), dtype=int)
+        color_index = np.zeros(0, dtype=int)
+        if len(colors):
+            self.palette, color_index = np.unique(colors, axis=0, return_inverse=True)
+        if 255 < len(self.palette):
+            raise ValueError("A sky panorama holds at most 255 star colors, got {}".format(len(self.palette)))
+
+        self.image = np.zeros((self.rows, self.columns), dtype=np.uint8)
+        if len(radii):
+            self.paint(get_directions(positions, camera.origin.pos + camera.displacement.pos),
+                       np.asarray(radii, dtype=float), color_index + 1)
+
+    def matches(self, camera):
+        return self.screen_dims == tuple(camera.screen_dims) and \
+            self.projection_plane_distance == camera.projection_plane_distance
+
+    def get_camera_rays(self):
+        """
+        The unit viewing ray through every screen pixel, as (W * H, 3)
+        components along the camera's right, up and facing vectors.
+        """
+        width, height = self.screen_dims
+        x, y = np.meshgrid(np.arange(width, dtype=np.float32) - width / 2,
+                           np.arange(height, dtype=np.float32) - height / 2, indexing='ij')
+        rays = np.empty((width * height, 3), dtype=np.float32)
+        rays[:, 0] = x.reshape(-1)
+        rays[:, 1] = y.reshape(-1)
+        rays[:, 2] = self.projection_plane_distance
+        rays /= np.sqrt(np.einsum('ij,ij->i', rays, rays))[:, np.newaxis]
+        return rays
+
+    def get_pixels(self, directions):
+        """
+        The panorama (row, column) each unit direction falls in.
+        """
+        polar = np.arccos(np.clip(directions[:, 2], -1, 1))
+        polar *= self.rows / math.pi
+        rows = np.minimum(polar.astype(np.int32), self.rows - 1)
+        azimuth = np.arctan2(directions[:, 1], directions[:, 0])
+        azimuth *= self.columns / (2 * math.pi)
+        columns = np.floor(azimuth).astype(np.int32) % self.columns
+        return rows, columns
+
+    def paint(self, directions, radii, color_index, block_stars=4096):
+        """
+        Stamps each star as a disc of its radius in screen pixels,
+        covering the same pixels as pygame.draw.circle, widened in
+        azimuth away from the equator to undo the stretching of the
+        projection.  Each star only visits the pixels it can reach, so
+        a star by a pole costs a few rows, not the whole panorama.
+        """
+        rows, columns = self.get_pixels(directions)
+        sin_polar = np.maximum(np.sqrt(1 - np.clip(directions[:, 2], -1, 1) ** 2), 1e-3)
+        reach = np.ceil(radii).astype(np.int64)
+        wide_reach = np.minimum(np.ceil(reach / sin_polar), self.columns // 2).astype(np.int64)
+
+        for start in range(0, len(radii), block_stars):
+            stars = np.arange(start, min(start + block_stars, len(radii)))
+            widths = 2 * wide_reach[stars] + 1
+            counts = (2 * reach[stars] + 1) * widths
+            # one entry per (star, dr, dc) in each star's own bounding box
+            star = np.repeat(stars, counts)
+            offset = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            width = np.repeat(widths, counts)
+            dr = offset // width - reach[star]
+            dc = offset % width - wide_reach[star]
+            inside = ((dc + 0.5) * sin_polar[star]) ** 2 + (dr + 0.5) ** 2 <= radii[star] ** 2
+            star, dr, dc = star[inside], dr[inside], dc[inside]
+            r = rows[star] + dr
+            on_image = (0 <= r) & (r < self.rows)
+            c = (columns[star] + dc) % self.columns
+            self.image[r[on_image], c[on_image]] = color_index[star[on_image]]
+
+    def get_view_pixels(self, camera):
+        """
+        The flat panorama index behind every screen pixel, worked out
+        again only when the camera has turned.
+        """
+        basis = np.array([camera.right, camera.up, camera.facing], dtype=np.float32)
+        if self.view_basis is None or not np.array_equal(basis, self.view_basis):
+            rows, columns = self.get_pixels(self.rays.dot(basis))
+            self.view_pixels = rows * self.columns + columns
+            self.view_basis = basis
+        return self.view_pixels
+
+    def draw(self, surface, camera):
+        """
+        Fills the surface with the part of the panorama in view.
+        """
+        pixels = self.get_view_pixels(camera)
+        colors = np.array([surface.map_rgb((0, 0, 0))] + [surface.map_rgb(tuple(c)) for c in self.palette])
+        frame = colors[self.image.ravel()[pixels]].reshape(self.screen_dims)
+        pygame.surfarray.blit_array(surface, frame)
@@ -0,0 +1,26 @@
+__author__ = 'charles.andrew.parker@gmail.com'
+
+import direct
+import barneshut
+import particlemesh
+import parallel
+import spatialhash
+
+
+SOLVERS = {
+    direct.DirectSolver.name: direct.DirectSolver,
+    barneshut.BarnesHutSolver.name: barneshut.BarnesHutSolver,
+    particlemesh.ParticleMeshSolver.name: particlemesh.ParticleMeshSolver,
+    parallel.ParallelDirectSolver.name: parallel.ParallelDirectSolver,
+}
+
+
+def get_solver(sim_config):
+    """
+    Builds the gravity solver named by sim_config["force_solver"],
+    defaulting to exact pairwise forces.
+    """
+    name = sim_config.get("force_solver", direct.DirectSolver.name)
+    if name not in SOLVERS:
+        raise ValueError("Unknown force solver {}; expected one of {}".format(name, sorted(SOLVERS)))
+    return SOLVERS[name](sim_config)
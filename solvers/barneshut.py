@@ -0,0 +1,255 @@
+__author__ = 'charles.andrew.parker@gmail.com'
+
+import logging
+import numpy as np
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+
+# Morton keys interleave this many bits per axis into a uint64
+MAX_DEPTH = 21
+
+
+def _spread_bits(x):
+    """
+    Spreads the low 21 bits of x so there are two zero
+    bits between each of them.
+    """
+    x = x & np.uint64(0x1fffff)
+    x = (x | (x << np.uint64(32))) & np.uint64(0x1f00000000ffff)
+    x = (x | (x << np.uint64(16))) & np.uint64(0x1f0000ff0000ff)
+    x = (x | (x << np.uint64(8))) & np.uint64(0x100f00f00f00f00f)
+    x = (x | (x << np.uint64(4))) & np.uint64(0x10c30c30c30c30c3)
+    x = (x | (x << np.uint64(2))) & np.uint64(0x1249249249249249)
+    return x
+
+
+def get_morton_keys(pos):
+    """
+    Returns the Morton (z-order) key of every position
+    inside the bounding cube of all positions.
+    """
+    lo = pos.min(axis=0)
+    span = (pos.max(axis=0) - lo).max()
+    if span <= 0:
+        span = 1.0
+    cells = (1 << MAX_DEPTH) - 1
+    grid = np.floor((pos - lo) * (cells / span)).astype(np.uint64)
+    return (_spread_bits(grid[:, 0]) |
+            (_spread_bits(grid[:, 1]) << np.uint64(1)) |
+            (_spread_bits(grid[:, 2]) << np.uint64(2)))
+
+
+def expand_ranges(owner, first, count):
+    """
+    For every owner[k], yields the indices first[k] .. first[k] + count[k] - 1.
+    Returns the repeated owners and the matching indices.
+    """
+    total = int(count.sum())
+    offsets = np.arange(total) - np.repeat(np.cumsum(count) - count, count)
+    return np.repeat(owner, count), np.repeat(first, count) + offsets
+
+
+class Octree(object):
+    """
+    Linear octree built from Morton-sorted bodies.
+
+    Nodes are stored level by level, and the children of a node are
+    contiguous, so building and summarising the tree are done with
+    array operations rather than per-node Python objects.
+    """
+
+    def __init__(self, pos, leaf_size):
+        self.num_bodies = len(pos)
+        self.leaf_size = leaf_size
+        keys = get_morton_keys(pos)
+        self.order = np.argsort(keys, kind='mergesort')
+        self.build(keys[self.order])
+
+    def build(self, keys):
+        starts = [np.array([0])]
+        ends = [np.array([self.num_bodies])]
+        level_offsets = [0, 1]
+        child_first = []
+        child_count = []
+
+        level = 0
+        to_split = np.nonzero(ends[0] - starts[0] > self.leaf_size)[0]
+        while len(to_split) > 0 and level < MAX_DEPTH:
+            level += 1
+            seg_start = starts[-1][to_split]
+            seg_len = ends[-1][to_split] - seg_start
+            parent, idx = expand_ranges(to_split, seg_start, seg_len)
+
+            prefix = keys[idx] >> np.uint64(3 * (MAX_DEPTH - level))
+            is_first = np.ones(len(idx), dtype=bool)
+            is_first[1:] = prefix[1:] != prefix[:-1]
+            is_first[np.cumsum(seg_len) - seg_len] = True
+
+            first_pos = np.nonzero(is_first)[0]
+            new_starts = idx[first_pos]
+            new_ends = idx[np.append(first_pos[1:], len(idx)) - 1] + 1
+
+            # record where each split parent's children begin
+            counts = np.zeros(len(starts[-1]), dtype=int)
+            counts[to_split] = np.bincount(np.searchsorted(to_split, parent[first_pos]),
+                                           minlength=len(to_split))
+            firsts = np.zeros(len(starts[-1]), dtype=int)
+            firsts[to_split] = level_offsets[-1] + np.cumsum(counts[to_split]) - counts[to_split]
+            child_first.append(firsts)
+            child_count.append(counts)
+
+            starts.append(new_starts)
+            ends.append(new_ends)
+            level_offsets.append(level_offsets[-1] + len(new_starts))
+            to_split = np.nonzero(new_ends - new_starts > self.leaf_size)[0]
+
+        child_first.append(np.zeros(len(starts[-1]), dtype=int))
+        child_count.append(np.zeros(len(starts[-1]), dtype=int))
+
+        self.level_offsets = level_offsets
+        self.start = np.concatenate(starts)
+        self.end = np.concatenate(ends)
+        self.child_first = np.concatenate(child_first)
+        self.child_count = np.concatenate(child_count)
+        self.is_leaf = self.child_count == 0
+        self.num_nodes = len(self.start)
+
+        leaves = np.nonzero(self.is_leaf)[0]
+        self.leaves = leaves[np.argsort(self.start[leaves], kind='mergesort')]
+
+    def summarize(self, pos, mass):
+        """
+        (Re)computes the mass, center of mass and bounding box of every
+        node for the current positions.  The topology is kept, so this
+        is also how the tree is refit between rebuilds.
+        """
+        sorted_pos = pos[self.order]
+        sorted_mass = mass[self.order]
+        leaf_starts = self.start[self.leaves]
+
+        self.mass = np.zeros(self.num_nodes)
+        self.moment = np.zeros((self.num_nodes, 3))
+        self.lo = np.zeros((self.num_nodes, 3))
+        self.hi = np.zeros((self.num_nodes, 3))
+
+        self.mass[self.leaves] = np.add.reduceat(sorted_mass, leaf_starts)
+        self.moment[self.leaves] = np.add.reduceat(sorted_mass[:, np.newaxis] * sorted_pos, leaf_starts)
+        self.lo[self.leaves] = np.minimum.reduceat(sorted_pos, leaf_starts)
+        self.hi[self.leaves] = np.maximum.reduceat(sorted_pos, leaf_starts)
+
+        for level in range(len(self.level_offsets) - 3, -1, -1):
+            ids = np.arange(self.level_offsets[level], self.level_offsets[level + 1])
+            ids = ids[~self.is_leaf[ids]]
+            if len(ids) == 0:
+                continue
+            below = slice(self.level_offsets[level + 1], self.level_offsets[level + 2])
+            first = self.child_first[ids] - self.level_offsets[level + 1]
+            self.mass[ids] = np.add.reduceat(self.mass[below], first)
+            self.moment[ids] = np.add.reduceat(self.moment[below], first)
+            self.lo[ids] = np.minimum.reduceat(self.lo[below], first)
+            self.hi[ids] = np.maximum.reduceat(self.hi[below], first)
+
+        self.com = self.moment / self.mass[:, np.newaxis]
+        self.extent = (self.hi - self.lo).max(axis=1)
+        center_offset = self.com - 0.5 * (self.lo + self.hi)
+        self.offset = np.sqrt(np.einsum('ij,ij->i', center_offset, center_offset))
+
+
+class BarnesHutSolver(object):
+    """
+    Approximate O(N log N) gravity from a Barnes-Hut octree.
+
+    A node is treated as a point mass when extent / distance is below
+    the opening angle (with the usual correction for the offset of its
+    center of mass).  All targets walk the tree together, one level of
+    opened nodes per pass.
+    """
+
+    name = "barnes_hut"
+
+    TARGET_BLOCK = 4096
+
+    # the tree is rebuilt from the positions it was built from
+    state_attributes = ("steps_since_rebuild", "tree_pos")
+
+    def __init__(self, sim_config):
+        self.sim_config = sim_config
+        self.opening_angle = sim_config.get("opening_angle", 0.5)
+        self.leaf_size = sim_config.get("tree_leaf_size", 8)
+        self.rebuild_interval = sim_config.get("tree_rebuild_interval", 1)
+        self.tree = None
+        self.tree_pos = None
+        self.steps_since_rebuild = 0
+        self.pairs_evaluated = 0
+
+    def update_tree(self, store):
+        if self.tree is None and self.tree_pos is not None and len(self.tree_pos) == len(store):
+            # restored from a checkpoint
+            self.tree = Octree(self.tree_pos, self.leaf_size)
+        if (self.tree is None or self.tree.num_bodies != len(store) or
+                self.rebuild_interval <= self.steps_since_rebuild):
+            log.debug("Rebuilding octree for {} bodies".format(len(store)))
+            self.tree = Octree(store.pos, self.leaf_size)
+            self.tree_pos = store.pos.copy()
+            self.steps_since_rebuild = 0
+        self.tree.summarize(store.pos, store.mass)
+        self.steps_since_rebuild += 1
+
+    def compute_accelerations(self, store, big_g):
+        """
+        Writes the acceleration of every body into store.acc.
+        """
+        n = len(store)
+        self.pairs_evaluated = 0
+        if n == 0:
+            return
+
+        self.update_tree(store)
+        for start in range(0, n, BarnesHutSolver.TARGET_BLOCK):
+            stop = min(start + BarnesHutSolver.TARGET_BLOCK, n)
+            store.acc[start:stop] = self.walk(store, big_g, start, stop)
+
+    def walk(self, store, big_g, start, stop):
+        tree = self.tree
+        pos, mass = store.pos, store.mass
+        acc = np.zeros((stop - start, 3))
+
+        def accumulate(targets, vect, weights):
+            for k in range(3):
+                acc[:, k] += np.bincount(targets - start, weights=weights * vect[:, k],
+                                         minlength=stop - start)
+
+        targets = np.arange(start, stop)
+        nodes = np.zeros(stop - start, dtype=int)
+        while len(targets) > 0:
+            vect = tree.com[nodes] - pos[targets]
+            dist = np.sqrt(np.einsum('ij,ij->i', vect, vect))
+            opened = dist * self.opening_angle <= tree.extent[nodes] + self.opening_angle * tree.offset[nodes]
+
+            accept = ~opened
+            self.pairs_evaluated += int(accept.sum())
+            accumulate(targets[accept], vect[accept],
+                       big_g * tree.mass[nodes[accept]] / dist[accept] ** 3)
+
+            # opened leaves interact directly with their members
+            leaf = opened & tree.is_leaf[nodes]
+            leaf_nodes = nodes[leaf]
+            t, slot = expand_ranges(targets[leaf], tree.start[leaf_nodes],
+                                    tree.end[leaf_nodes] - tree.start[leaf_nodes])
+            b = tree.order[slot]
+            other = t != b
+            t, b = t[other], b[other]
+            self.pairs_evaluated += len(t)
+            d_vect = pos[b] - pos[t]
+            d_dist = np.sqrt(np.einsum('ij,ij->i', d_vect, d_vect))
+            accumulate(t, d_vect, big_g * mass[b] / d_dist ** 3)
+
+            # opened internal nodes are replaced by their children
+            inner = opened & ~tree.is_leaf[nodes]
+            inner_nodes = nodes[inner]
+            targets, nodes = expand_ranges(targets[inner], tree.child_first[inner_nodes],
+                                           tree.child_count[inner_nodes])
+
+        return acc
@@ -0,0 +1,87 @@
+__author__ = 'charles.andrew.parker@gmail.com'
+
+import logging
+import numpy as np
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+
+def get_block_size(num_bodies, max_block_elements=2 ** 20):
+    """
+    Number of target rows to evaluate at once so that the
+    (rows, num_bodies, 3) separation block stays bounded.
+    """
+    return max(1, min(num_bodies, max_block_elements // max(num_bodies, 1)))
+
+
+def accumulate_accelerations(targets, pos, mass, big_g, out, target_indices=None):
+    """
+    Computes the exact acceleration on every position in `targets`
+    due to every body in `pos`/`mass` and writes it into `out`.
+
+    If `target_indices` is given, targets[k] is body target_indices[k]
+    and its self-interaction is skipped.
+    """
+    block = get_block_size(len(mass))
+
+    for start in range(0, len(targets), block):
+        stop = min(start + block, len(targets))
+        vect = pos[np.newaxis, :, :] - targets[start:stop, np.newaxis, :]
+        dist_sq = np.einsum('ijk,ijk->ij', vect, vect)
+
+        if target_indices is not None:
+            rows = np.arange(stop - start)
+            dist_sq[rows, target_indices[start:stop]] = np.inf
+
+        dist = np.sqrt(dist_sq)
+        weights = mass[np.newaxis, :] / (dist_sq * dist)
+        out[start:stop] = big_g * np.einsum('ij,ijk->ik', weights, vect)
+
+
+def accumulate_accelerations_and_jerks(target_indices, pos, vel, mass, big_g, acc_out, jerk_out):
+    """
+    Computes the exact acceleration and its time derivative (jerk)
+    on bodies target_indices due to every body, writing them into
+    acc_out and jerk_out (one row per target).
+    """
+    block = get_block_size(len(mass))
+
+    for start in range(0, len(target_indices), block):
+        stop = min(start + block, len(target_indices))
+        own = target_indices[start:stop]
+        vect = pos[np.newaxis, :, :] - pos[own, np.newaxis, :]
+        rel_vel = vel[np.newaxis, :, :] - vel[own, np.newaxis, :]
+        dist_sq = np.einsum('ijk,ijk->ij', vect, vect)
+        dist_sq[np.arange(stop - start), own] = np.inf
+
+        dist = np.sqrt(dist_sq)
+        weights = mass[np.newaxis, :] / (dist_sq * dist)
+        rate = 3.0 * np.einsum('ijk,ijk->ij', vect, rel_vel) / dist_sq
+        acc_out[start:stop] = big_g * np.einsum('ij,ijk->ik', weights, vect)
+        jerk_out[start:stop] = big_g * (np.einsum('ij,ijk->ik', weights, rel_vel) -
+                                        np.einsum('ij,ijk->ik', weights * rate, vect))
+
+
+class DirectSolver(object):
+    """
+    Exact O(N**2) pairwise gravity, evaluated in
+    bounded blocks of target bodies.
+    """
+
+    name = "direct"
+    # attributes carried from one step to the next, saved in checkpoints
+    state_attributes = ()
+
+    def __init__(self, sim_config):
+        self.sim_config = sim_config
+        self.pairs_evaluated = 0
+
+    def compute_accelerations(self, store, big_g):
+        """
+        Writes the acceleration of every body into store.acc.
+        """
+        n = len(store)
+        self.pairs_evaluated = n * (n - 1) // 2
+        accumulate_accelerations(store.pos, store.pos, store.mass, big_g, store.acc,
+                                 target_indices=np.arange(n))
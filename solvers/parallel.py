@@ -0,0 +1,148 @@
+__author__ = 'charles.andrew.parker@gmail.com'
+
+import Queue
+import logging
+import multiprocessing
+import traceback
+from multiprocessing import sharedctypes
+import numpy as np
+import direct
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+
+def get_shared_views(buffers, capacity):
+    """
+    Numpy views of the shared position, mass and acceleration
+    buffers.  No data is copied.
+    """
+    pos, mass, acc = buffers
+    return (np.frombuffer(pos, dtype=np.float64).reshape((capacity, 3)),
+            np.frombuffer(mass, dtype=np.float64),
+            np.frombuffer(acc, dtype=np.float64).reshape((capacity, 3)))
+
+
+def force_worker(buffers, capacity, tasks, results):
+    """
+    Worker loop: computes the accelerations of a range of target
+    rows straight into the shared output buffer.
+    """
+    pos, mass, acc = get_shared_views(buffers, capacity)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        start, stop, n, big_g = task
+        try:
+            direct.accumulate_accelerations(pos[start:stop], pos[:n], mass[:n], big_g, acc[start:stop],
+                                            target_indices=np.arange(start, stop))
+        except Exception:
+            # the parent raises it; carry on so the pool can be shut down
+            results.put(("error", traceback.format_exc()))
+        else:
+            results.put(("done", stop - start))
+
+
+class ParallelDirectSolver(object):
+    """
+    Exact pairwise gravity split across a persistent pool of worker
+    processes.  Positions and masses are copied once per step
+    into shared memory, every worker reads all of them and writes the
+    accelerations of its own target rows into a shared output buffer.
+    """
+
+    name = "parallel"
+    state_attributes = ()
+
+    # how often a step waiting on its workers checks they are alive
+    RESULT_POLL_SECONDS = 1.0
+    JOIN_SECONDS = 5.0
+
+    def __init__(self, sim_config):
+        self.sim_config = sim_config
+        self.num_workers = sim_config.get("num_workers", multiprocessing.cpu_count())
+        self.min_bodies = sim_config.get("parallel_min_bodies", 256)
+        self.tasks_per_worker = sim_config.get("parallel_tasks_per_worker", 4)
+        self.capacity = 0
+        self.workers = []
+        self.pairs_evaluated = 0
+
+    def start_pool(self, capacity):
+        self.close()
+        log.debug("Starting {} force workers for {} bodies".format(self.num_workers, capacity))
+        self.capacity = capacity
+        self.buffers = (sharedctypes.RawArray('d', 3 * capacity),
+                        sharedctypes.RawArray('d', capacity),
+                        sharedctypes.RawArray('d', 3 * capacity))
+        self.pos, self.mass, self.acc = get_shared_views(self.buffers, capacity)
+        self.tasks = multiprocessing.Queue()
+        self.results = multiprocessing.Queue()
+        for _ in range(self.num_workers):
+            worker = multiprocessing.Process(target=force_worker,
+                                             args=(self.buffers, capacity, self.tasks, self.results))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def close(self):
+        """
+        Stops the worker pool, killing any worker that does not stop
+        in time.  It is restarted on the next step that needs it.
+        """
+        for worker in self.workers:
+            if worker.is_alive():
+                self.tasks.put(None)
+        for worker in self.workers:
+            worker.join(ParallelDirectSolver.JOIN_SECONDS)
+            if worker.is_alive():
+                log.warning("Force worker {} did not stop, terminating it".format(worker.pid))
+                worker.terminate()
+                worker.join()
+        self.workers = []
+        self.capacity = 0
+
+    def wait_for_results(self, count):
+        """
+        Waits for count finished tasks.  Raises RuntimeError, after
+        shutting the pool down, if a task failed or a worker died.
+        """
+        for _ in range(count):
+            while True:
+                try:
+                    status, value = self.results.get(timeout=ParallelDirectSolver.RESULT_POLL_SECONDS)
+                    break
+                except Queue.Empty:
+                    dead = [w for w in self.workers if not w.is_alive()]
+                    if dead:
+                        self.close()
+                        raise RuntimeError("Force worker {} exited with code {}".format(dead[0].pid,
+                                                                                       dead[0].exitcode))
+            if status == "error":
+                self.close()
+                raise RuntimeError("Force worker failed:\n{}".format(value))
+
+    def compute_accelerations(self, store, big_g):
+        """
+        Writes the acceleration of every body into store.acc.
+        """
+        n = len(store)
+        self.pairs_evaluated = n * (n - 1) // 2
+        if n < self.min_bodies or self.num_workers < 2:
+            direct.accumulate_accelerations(store.pos, store.pos, store.mass, big_g, store.acc,
+                                            target_indices=np.arange(n))
+            return
+
+        if self.capacity < n:
+            self.start_pool(max(n, 2 * self.capacity))
+
+        self.pos[:n] = store.pos
+        self.mass[:n] = store.mass
+
+        bounds = np.linspace(0, n, self.num_workers * self.tasks_per_worker + 1).astype(int)
+        tasks = [(start, stop, n, big_g) for start, stop in zip(bounds[:-1], bounds[1:]) if start < stop]
+        for task in tasks:
+            self.tasks.put(task)
+        self.wait_for_results(len(tasks))
+
+        store.acc = self.acc[:n]
@@ -0,0 +1,138 @@
+__author__ = 'charles.andrew.parker@gmail.com'
+
+import logging
+import math
+import numpy as np
+import spatialhash
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+
+def erf(x):
+    """
+    Vectorised error function for x >= 0
+    (Abramowitz & Stegun 7.1.26, |error| < 1.5e-7).
+    """
+    t = 1.0 / (1.0 + 0.3275911 * x)
+    poly = t * (0.254829592 + t * (-0.284496736 + t * (1.421413741 + t * (-1.453152027 + t * 1.061405429))))
+    return 1.0 - poly * np.exp(-x * x)
+
+
+def get_cic_weights(grid_pos):
+    """
+    Cloud-in-cell interpolation: returns the flat grid node of each
+    of the 8 corners around every position, and the matching weights.
+    """
+    base = np.floor(grid_pos).astype(int)
+    frac = grid_pos - base
+    corners = []
+    weights = []
+    for dx in (0, 1):
+        for dy in (0, 1):
+            for dz in (0, 1):
+                corners.append(base + np.array([dx, dy, dz]))
+                w = np.abs(1 - dx - frac[:, 0]) * np.abs(1 - dy - frac[:, 1]) * np.abs(1 - dz - frac[:, 2])
+                weights.append(w)
+    return corners, weights
+
+
+class ParticleMeshSolver(object):
+    """
+    Long-range gravity on a mesh.
+
+    Masses are deposited onto a cubic grid with cloud-in-cell weights,
+    the potential is found by convolving with the Green's function
+    using zero-padded FFTs (so the boundaries are isolated, not
+    periodic), and accelerations are interpolated back to the bodies.
+
+    With "pm_short_range" enabled the mesh only carries the smooth
+    erf part of 1/r and the remaining erfc part is summed directly over
+    neighbours within a few cells (P3M).  Otherwise the mesh force is
+    softened on the scale of a cell.
+    """
+
+    name = "particle_mesh"
+    state_attributes = ()
+
+    def __init__(self, sim_config):
+        self.sim_config = sim_config
+        self.mesh_size = sim_config.get("mesh_size", 64)
+        self.short_range = sim_config.get("pm_short_range", False)
+        self.split_cells = sim_config.get("pm_split_scale", 1.25)
+        self.cutoff_scale = sim_config.get("pm_short_range_cutoff", 4.5)
+        self.kernel_key = None
+        self.kernel_fft = None
+        self.pairs_evaluated = 0
+
+    def get_cell_size(self, pos):
+        """
+        Cell size covering all bodies with a cell of margin, rounded
+        up to a power of two so the Green's function can be reused
+        while the cloud keeps roughly the same extent.
+        """
+        span = (pos.max(axis=0) - pos.min(axis=0)).max()
+        needed = max(span, 1.0) / (self.mesh_size - 3)
+        return 2.0 ** math.ceil(math.log(needed, 2))
+
+    def get_kernel_fft(self, cell_size, big_g):
+        key = (cell_size, big_g)
+        if self.kernel_key != key:
+            log.debug("Building Green's function for cell size {}".format(cell_size))
+            n = self.mesh_size
+            dist = np.minimum(np.arange(2 * n), 2 * n - np.arange(2 * n)) * cell_size
+            r = np.sqrt(dist[:, None, None] ** 2 + dist[None, :, None] ** 2 + dist[None, None, :] ** 2)
+            if self.short_range:
+                split = self.split_cells * cell_size
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    kernel = erf(r / (2 * split)) / r
+                kernel[0, 0, 0] = 1.0 / (split * math.sqrt(math.pi))
+            else:
+                kernel = 1.0 / np.sqrt(r ** 2 + cell_size ** 2)
+            self.kernel_fft = np.fft.rfftn(-big_g * kernel)
+            self.kernel_key = key
+        return self.kernel_fft
+
+    def get_mesh_accelerations(self, pos, mass, big_g, out):
+        n = self.mesh_size
+        cell_size = self.get_cell_size(pos)
+        lo = pos.min(axis=0) - cell_size
+
+        corners, weights = get_cic_weights((pos - lo) / cell_size)
+        flat = [np.ravel_multi_index(c.T, (n, n, n)) for c in corners]
+
+        rho = np.zeros((2 * n, 2 * n, 2 * n))
+        rho[:n, :n, :n] = sum(np.bincount(f, weights=w * mass, minlength=n ** 3)
+                              for f, w in zip(flat, weights)).reshape((n, n, n))
+
+        phi = np.fft.irfftn(np.fft.rfftn(rho) * self.get_kernel_fft(cell_size, big_g),
+                            rho.shape)[:n, :n, :n]
+        field = [-g.ravel() for g in np.gradient(phi, cell_size)]
+
+        for k in range(3):
+            out[:, k] = sum(field[k][f] * w for f, w in zip(flat, weights))
+        return cell_size
+
+    def add_short_range_accelerations(self, store, big_g, cell_size):
+        split = self.split_cells * cell_size
+        n = len(store)
+        for i, j, vect, dist in spatialhash.iter_close_pairs(store.pos, self.cutoff_scale * split):
+            self.pairs_evaluated += len(i)
+            u = dist / (2 * split)
+            scale = ((1.0 - erf(u)) + dist / (split * math.sqrt(math.pi)) * np.exp(-u * u)) / dist ** 3
+            for k in range(3):
+                component = big_g * scale * vect[:, k]
+                store.acc[:, k] += np.bincount(i, weights=component * store.mass[j], minlength=n)
+                store.acc[:, k] -= np.bincount(j, weights=component * store.mass[i], minlength=n)
+
+    def compute_accelerations(self, store, big_g):
+        """
+        Writes the acceleration of every body into store.acc.
+        """
+        self.pairs_evaluated = 0
+        if len(store) == 0:
+            return
+
+        cell_size = self.get_mesh_accelerations(store.pos, store.mass, big_g, store.acc)
+        if self.short_range:
+            self.add_short_range_accelerations(store, big_g, cell_size)
@@ -0,0 +1,129 @@
+__author__ = 'charles.andrew.parker@gmail.com'
+
+import logging
+import itertools
+import numpy as np
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+
+# The cell itself plus half of its 26 neighbours, so every
+# pair of neighbouring cells is visited exactly once
+HALF_NEIGHBOURHOOD = [off for off in itertools.product((-1, 0, 1), repeat=3) if off > (0, 0, 0)]
+
+
+def get_cell_keys(pos, cell_size):
+    """
+    Hashes every position to the integer key of the uniform grid
+    cell containing it.  Keys are laid out so that the neighbour
+    at offset (dx, dy, dz) is key + dx * strides[0] + dy * strides[1] + dz.
+    """
+    cells = np.floor(pos / cell_size).astype(np.int64)
+    cells -= cells.min(axis=0) - 1
+    dims = cells.max(axis=0) + 2
+    strides = np.array([dims[1] * dims[2], dims[2], 1], dtype=np.int64)
+    return cells.dot(strides), strides
+
+
+def iter_candidate_pairs(pos, cell_size, max_pairs=2 ** 22):
+    """
+    Yields (i, j) arrays, i < j, covering every pair of bodies lying in
+    the same or neighbouring cells of a uniform grid with the given
+    cell size, at most about max_pairs at a time.  Any pair closer than
+    cell_size is guaranteed to be included.
+    """
+    if len(pos) < 2:
+        return
+
+    # keep the number of cells along an axis representable
+    span = (pos.max(axis=0) - pos.min(axis=0)).max()
+    cell_size = max(cell_size, span / 2.0 ** 20)
+
+    keys, strides = get_cell_keys(pos, cell_size)
+    order = np.argsort(keys, kind='mergesort')
+    cell_keys, cell_start, cell_count = np.unique(keys[order], return_index=True, return_counts=True)
+
+    # pairs within a cell
+    multi = np.nonzero(1 < cell_count)[0]
+    for a, b in _expand_cell_pairs(cell_start[multi], cell_count[multi],
+                                   cell_start[multi], cell_count[multi], max_pairs):
+        upper = a < b
+        yield order[a[upper]], order[b[upper]]
+
+    # pairs between a cell and its neighbours
+    for off in HALF_NEIGHBOURHOOD:
+        wanted = cell_keys + np.dot(off, strides)
+        slot = np.searchsorted(cell_keys, wanted)
+        slot[slot == len(cell_keys)] = 0
+        found = np.nonzero(cell_keys[slot] == wanted)[0]
+        for a, b in _expand_cell_pairs(cell_start[found], cell_count[found],
+                                       cell_start[slot[found]], cell_count[slot[found]], max_pairs):
+            i, j = order[a], order[b]
+            yield np.minimum(i, j), np.maximum(i, j)
+
+
+def get_candidate_pairs(pos, cell_size):
+    """
+    All of iter_candidate_pairs at once.
+    """
+    chunks = list(iter_candidate_pairs(pos, cell_size))
+    if len(chunks) == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    first, second = zip(*chunks)
+    return np.concatenate(first), np.concatenate(second)
+
+
+def _expand_cell_pairs(start_a, count_a, start_b, count_b, max_pairs):
+    """
+    Yields every combination of a member of cell a with a member of
+    cell b, as positions in the sorted order, in batches of whole
+    cell pairs holding about max_pairs combinations.
+    """
+    sizes = count_a * count_b
+    bounds = np.cumsum(sizes)
+    lo = 0
+    while lo < len(sizes):
+        done = bounds[lo - 1] if lo > 0 else 0
+        hi = max(lo + 1, int(np.searchsorted(bounds, done + max_pairs, side='right')))
+        batch = sizes[lo:hi]
+        total = int(batch.sum())
+        owner = np.repeat(np.arange(lo, hi), batch)
+        local = np.arange(total) - np.repeat(np.cumsum(batch) - batch, batch)
+        nb = count_b[owner]
+        yield start_a[owner] + local // nb, start_b[owner] + local % nb
+        lo = hi
+
+
+def iter_close_pairs(pos, cutoff):
+    """
+    Yields (i, j, vect, dist) batches for every pair closer than
+    cutoff, where vect points from body i to body j.
+    """
+    for i, j in iter_candidate_pairs(pos, cutoff):
+        vect = pos[j] - pos[i]
+        dist = np.sqrt(np.einsum('ij,ij->i', vect, vect))
+        close = dist < cutoff
+        yield i[close], j[close], vect[close], dist[close]
+
+
+def get_close_pairs(pos, cutoff):
+    """
+    All of iter_close_pairs at once.
+    """
+    batches = list(iter_close_pairs(pos, cutoff))
+    if len(batches) == 0:
+        return (np.zeros(0, dtype=int), np.zeros(0, dtype=int),
+                np.zeros((0, 3)), np.zeros(0))
+    return tuple(np.concatenate(parts) for parts in zip(*batches))
+
+
+def get_overlapping_pairs(pos, radius):
+    """
+    Returns the (M, 2) index pairs of bodies whose radii overlap.
+    """
+    if len(pos) < 2:
+        return np.zeros((0, 2), dtype=int)
+    i, j, _, dist = get_close_pairs(pos, 2.0 * radius.max())
+    touching = dist < radius[i] + radius[j]
+    return np.column_stack((i[touching], j[touching]))
@@ -0,0 +1,97 @@
+__author__ = 'charles.andrew.parker@gmail.com'
+
+import collections
+import logging
+import threading
+import time
+import numpy as np
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+
+class Tracer(object):
+    """
+    Keeps the most recent structured events in a fixed-size ring
+    buffer.  An event is (time, subsystem, name, values); nothing is
+    formatted until the buffer is dumped, so tracing the hot loops
+    costs a function call and a tuple while enabled and a single
+    attribute test while disabled.
+
+    Each subsystem keeps one in every sample_interval events, so the
+    per-body and per-projection subsystems can be thinned out while
+    the rarer ones are kept whole.  Array values are copied when kept,
+    since most of them are views into the body store.
+
+    Events come from the simulation thread and the drawing thread, so
+    the buffer and the sample counts are only touched under a lock.
+    """
+
+    def __init__(self, size=4096):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.sample_intervals = {}
+        self.seen = collections.defaultdict(int)
+        self.events = collections.deque(maxlen=size)
+
+    def configure(self, sim_config):
+        """
+        Applies the trace_* settings.  Entry points call this once:
+        several simulations can run at a time and share the buffer.
+        """
+        self.enabled = sim_config.get("trace_enabled", False)
+        self.sample_intervals = dict(sim_config.get("trace_sample_intervals", {}))
+        size = sim_config.get("trace_buffer_size", 4096)
+        with self.lock:
+            if size != self.events.maxlen:
+                self.events = collections.deque(self.events, maxlen=size)
+
+    def set_sample_interval(self, subsystem, interval):
+        self.sample_intervals[subsystem] = interval
+
+    def record(self, subsystem, name, *values):
+        if self.enabled is False:
+            return
+        with self.lock:
+            seen = self.seen[subsystem]
+            self.seen[subsystem] = seen + 1
+        if seen % self.sample_intervals.get(subsystem, 1) != 0:
+            return
+        values = tuple(v.copy() if isinstance(v, np.ndarray) else v for v in values)
+        with self.lock:
+            self.events.append((time.time(), subsystem, name, values))
+
+    def clear(self):
+        with self.lock:
+            self.events.clear()
+            self.seen.clear()
+
+    def get_events(self, subsystem=None):
+        """
+        The buffered events, oldest first.
+        """
+        with self.lock:
+            return [e for e in self.events if subsystem is None or e[1] == subsystem]
+
+    @staticmethod
+    def format_event(event):
+        t, subsystem, name, values = event
+        return "{:.6f} {} {} {}".format(t, subsystem, name, " ".join(str(v) for v in values))
+
+    def dump(self, path=None, subsystem=None):
+        """
+        Formats the buffered events, oldest first, into the file at
+        path or, without one, the log.
+        """
+        lines = [Tracer.format_event(e) for e in self.get_events(subsystem)]
+        if path is None:
+            for line in lines:
+                log.info(line)
+        else:
+            with open(path, "a") as f:
+                f.write("".join(line + "\n" for line in lines))
+        return len(lines)
+
+
+# shared by the coordinate, camera and drawing code
+tracer = Tracer()
@@ -0,0 +1,141 @@
+__author__ = 'charles.andrew.parker@gmail.com'
+
+import logging
+import numpy as np
+import pygame
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+
+def get_line_pixels(start, stop):
+    """
+    The pixels of the 1-pixel lines from each (x, y) in start to the
+    matching one in stop, as x, y and the index of the line each
+    pixel belongs to.
+    """
+    delta = stop - start
+    steps = np.abs(delta).max(axis=1)
+    counts = steps + 1
+    line = np.repeat(np.arange(len(start)), counts)
+    k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    t = k / np.maximum(steps[line], 1).astype(float)
+    x = np.round(start[line, 0] + t * delta[line, 0]).astype(int)
+    y = np.round(start[line, 1] + t * delta[line, 1]).astype(int)
+    return x, y, line
+
+
+def set_pixels(surface, x, y, colors):
+    """
+    Sets the pixels at x, y to the (M, 3) colors, on
+    surfaces of any bit depth.
+    """
+    if 3 <= surface.get_bytesize():
+        pixels = pygame.surfarray.pixels3d(surface)
+        pixels[x, y] = colors
+    else:
+        pixels = pygame.surfarray.pixels2d(surface)
+        pixels[x, y] = pygame.surfarray.map_array(surface, colors[np.newaxis])[0]
+    del pixels
+
+
+def get_trail_key(b):
+    """
+    What a body's trail is kept under: its column for planets read
+    from a recording, which are new objects every frame, otherwise
+    the body itself.  Names are no good, as bodies often share them.
+    """
+    recording_id = getattr(b, "recording_id", None)
+    if recording_id is not None:
+        return "recording", recording_id
+    return b
+
+
+class TrailBuffer(object):
+    """
+    The last `length` world positions of every body, sampled every
+    `interval` steps into one (N, length, 3) ring buffer shared by
+    all bodies.
+
+    Trails are kept in world space and projected when drawn, so they
+    survive the camera moving.  Rows follow the bodies themselves when
+    bodies are merged away, and their recording column when the
+    planets are replaced on every frame of a replay.
+    """
+
+    def __init__(self, length=40, interval=1):
+        self.length = length
+        self.interval = interval
+        self.bodies = None
+        self.keys = []
+        self.colors = np.zeros((0, 3), dtype=np.uint8)
+        self.positions = np.zeros((0, length, 3))
+        self.filled = np.zeros(0, dtype=int)
+        self.head = 0
+        self.counter = 0
+
+    def sync(self, store):
+        """
+        Lines the rows up with the bodies in the store.
+        """
+        if self.bodies is store.bodies and len(self.keys) == len(store):
+            return
+
+        keys = [get_trail_key(b) for b in store.bodies]
+        rows = dict((key, i) for i, key in enumerate(self.keys))
+        old = np.array([rows.get(key, -1) for key in keys], dtype=int)
+        kept = old >= 0
+
+        positions = np.zeros((len(keys), self.length, 3))
+        filled = np.zeros(len(keys), dtype=int)
+        positions[kept] = self.positions[old[kept]]
+        filled[kept] = self.filled[old[kept]]
+
+        self.bodies = store.bodies
+        self.keys = keys
+        self.colors = np.array([b.color for b in store.bodies], dtype=np.uint8).reshape(-1, 3)
+        self.positions = positions
+        self.filled = filled
+
+    def sample(self, store):
+        self.sync(store)
+        if self.counter % self.interval == 0:
+            self.positions[:, self.head] = store.pos
+            self.head = (self.head + 1) % self.length
+            self.filled = np.minimum(self.filled + 1, self.length)
+        self.counter += 1
+
+    def clear(self):
+        self.filled[:] = 0
+
+    def get_trails(self):
+        """
+        The positions oldest first, with a mask of the
+        slots that have been sampled.
+        """
+        ordered = np.roll(self.positions, -self.head, axis=1)
+        sampled = np.arange(self.length) >= (self.length - self.filled)[:, np.newaxis]
+        return ordered, sampled
+
+    def draw(self, surface, camera):
+        """
+        Projects every trail at once and draws the segments whose
+        ends are both in view.  Returns the number of segments drawn.
+        """
+        if len(self.keys) == 0 or self.length < 2:
+            return 0
+
+        ordered, sampled = self.get_trails()
+        _, screen_pos, visible = camera.project(ordered.reshape(-1, 3), 0.0)
+        screen_pos = screen_pos.reshape(len(self.keys), self.length, 2)
+        shown = (sampled & visible.reshape(sampled.shape))
+        segments = shown[:, :-1] & shown[:, 1:]
+        body, first = np.nonzero(segments)
+        if len(body) == 0:
+            return 0
+
+        x, y, line = get_line_pixels(screen_pos[body, first], screen_pos[body, first + 1])
+        width, height = surface.get_size()
+        inside = (0 <= x) & (x < width) & (0 <= y) & (y < height)
+        set_pixels(surface, x[inside], y[inside], self.colors[body[line[inside]]])
+        return len(body)